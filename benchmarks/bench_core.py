@@ -0,0 +1,206 @@
+"""Throughput and memory benchmarks for stego_core.
+
+    python benchmarks/bench_core.py                    # quick preset, compared with baseline.json
+    python benchmarks/bench_core.py --preset full      # 0.1 to 50 MP covers
+    python benchmarks/bench_core.py --save-baseline    # record this machine's numbers
+
+Covers are synthetic (a gradient plus seeded noise) and cached between runs,
+so the suite needs no network or sample data. Every case runs in a fresh
+interpreter, which makes its peak RSS its own. A case regresses when a time
+or the peak RSS exceeds the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stego_core  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+PRESETS = {
+    "quick": [0.1, 1, 4],
+    "full": [0.1, 1, 4, 12, 24, 50],
+}
+PAYLOADS = ("small", "tenth", "near")
+CONTENTS = ("text", "random")
+SMALL_PAYLOAD = 4 * 1024
+
+# Differences below these are noise whatever the tolerance says
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 16
+
+def cover_size(megapixels):
+    """4:3 cover dimensions for a megapixel count"""
+    pixels = int(megapixels * 1_000_000)
+    width = int((pixels * 4 / 3) ** 0.5)
+    return width, pixels // width
+
+def ensure_cover(megapixels, cache_dir):
+    width, height = cover_size(megapixels)
+    path = os.path.join(cache_dir, f"cover_{width}x{height}.png")
+    if not os.path.exists(path):
+        rng = np.random.default_rng(width * height)
+        ramp = (np.add.outer(np.arange(height) * 255 // max(1, height - 1),
+                             np.arange(width) * 255 // max(1, width - 1)) // 2).astype(np.int16)
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        for channel, shift in enumerate((0, 40, 80)):
+            noise = rng.integers(-12, 13, size=(height, width), dtype=np.int16)
+            pixels[..., channel] = np.clip((ramp + shift) % 256 + noise, 0, 255)
+        Image.fromarray(pixels).save(path, "PNG", compress_level=1)
+    return path
+
+def payload_size(megapixels, payload):
+    width, height = cover_size(megapixels)
+    capacity = stego_core.max_payload_size(width, height)
+    if payload == "small":
+        return min(SMALL_PAYLOAD, capacity // 2)
+    if payload == "tenth":
+        return capacity // 10
+    # Random data grows slightly under zlib, so leave some headroom
+    return int(capacity * 0.95)
+
+def make_payload(content, size):
+    if content == "random":
+        return np.random.default_rng(size).bytes(size)
+    line = b"The quick brown fox jumps over the lazy dog. 0123456789\n"
+    return (line * (size // len(line) + 1))[:size]
+
+def case_name(megapixels, payload, content):
+    return f"{megapixels}mp-{payload}-{content}"
+
+def iter_cases(preset):
+    for megapixels in PRESETS[preset]:
+        for payload in PAYLOADS:
+            for content in CONTENTS:
+                yield megapixels, payload, content
+
+def _timed(timings, stage, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+    return result
+
+def run_case(megapixels, payload, content, cache_dir):
+    """Time one case end to end and stage by stage; runs inside the child interpreter"""
+    cover = ensure_cover(megapixels, cache_dir)
+    data = make_payload(content, payload_size(megapixels, payload))
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as work:
+        output = os.path.join(work, "out.png")
+
+        # End to end through the public API, with the engines' own per-stage stats
+        encode_stats = stego_core.Stats()
+        _timed(timings, "encode", stego_core.encode_data_to_image, cover, data, output,
+               stats=encode_stats)
+        decode_stats = stego_core.Stats()
+        decoded = _timed(timings, "decode", stego_core.decode_data_from_image, output,
+                         stats=decode_stats)
+        if decoded != data:
+            raise AssertionError(f"round trip mismatch for {case_name(megapixels, payload, content)}")
+        for prefix, stats in (("encode", encode_stats), ("decode", decode_stats)):
+            for stage, seconds in stats.seconds.items():
+                timings[f"{prefix}.{stage}"] = seconds
+
+    return {
+        "megapixels": megapixels,
+        "payload_bytes": len(data),
+        "seconds": {stage: round(value, 4) for stage, value in timings.items()},
+        "encode_mb_s": round(len(data) / 1e6 / timings["encode"], 2),
+        "decode_mb_s": round(len(data) / 1e6 / timings["decode"], 2),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def run_in_child(case, cache_dir):
+    megapixels, payload, content = case
+    command = [sys.executable, os.path.abspath(__file__), "--run-case",
+               str(megapixels), payload, content, "--cache-dir", cache_dir]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{case_name(*case)} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout)
+
+def compare(name, result, baseline, tolerance):
+    """List the metrics of result that regressed against baseline"""
+    regressions = []
+    for stage in ("encode", "decode"):
+        old = baseline["seconds"].get(stage)
+        new = result["seconds"][stage]
+        if old and new > old * (1 + tolerance) and new - old > MIN_SECONDS:
+            regressions.append(f"{name}: {stage} {new:.3f}s vs baseline {old:.3f}s")
+    old = baseline.get("peak_rss_mb")
+    new = result["peak_rss_mb"]
+    if old and new > old * (1 + tolerance) and new - old > MIN_RSS_MB:
+        regressions.append(f"{name}: peak RSS {new:.0f} MB vs baseline {old:.0f} MB")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "stego-bench"),
+                        help="where generated covers are kept between runs")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or growth (default 0.25)")
+    parser.add_argument("--json", help="also write the raw results to this file")
+    parser.add_argument("--run-case", nargs=3, metavar=("MP", "PAYLOAD", "CONTENT"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    if args.run_case:
+        megapixels, payload, content = args.run_case
+        print(json.dumps(run_case(float(megapixels), payload, content, args.cache_dir)))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'case':<24}{'payload':>12}{'encode s':>10}{'decode s':>10}{'enc MB/s':>10}{'dec MB/s':>10}{'peak MB':>9}")
+    for case in iter_cases(args.preset):
+        # Generate covers up front so their cost never lands in a measurement
+        ensure_cover(case[0], args.cache_dir)
+        name = case_name(*case)
+        result = results[name] = run_in_child(case, args.cache_dir)
+        seconds = result["seconds"]
+        print(f"{name:<24}{result['payload_bytes']:>12}{seconds['encode']:>10.3f}{seconds['decode']:>10.3f}"
+              f"{result['encode_mb_s']:>10.2f}{result['decode_mb_s']:>10.2f}{result['peak_rss_mb']:>9.0f}")
+        if name in baseline:
+            regressions.extend(compare(name, result, baseline[name], args.tolerance))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} REGRESSION(S) against {args.baseline}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    if not baseline:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
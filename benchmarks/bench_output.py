@@ -0,0 +1,94 @@
+"""Save time versus file size for each output profile.
+
+    python benchmarks/bench_output.py                      # synthetic 1 and 4 MP covers
+    python benchmarks/bench_output.py --covers a.png b.jpg # your own covers
+    python benchmarks/bench_output.py --profiles png png-fast webp
+
+Each cover gets a payload of a tenth of its capacity, encoded with
+encode_image once per profile and run; the time of its save stage is what
+counts. Every output is decoded again to check it is lossless.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stego_core  # noqa: E402
+from bench_core import ensure_cover, make_payload  # noqa: E402
+
+DEFAULT_MEGAPIXELS = [1, 4]
+
+def run_cover(cover, profiles, repeat, work):
+    data = make_payload("text", stego_core.capacity(cover) // 10)
+    with Image.open(cover) as img:
+        width, height = img.size
+        mode, _ = stego_core.cover_mode(img.mode)
+    raw_bytes = width * height * stego_core.PIXEL_MODES[mode].bands
+    results = []
+    for name in profiles:
+        profile = stego_core.output_profile(name)
+        output = os.path.join(work, "out" + profile.extension)
+        best = None
+        for _ in range(repeat):
+            stats = stego_core.Stats()
+            stego_core.encode_image(cover, data, output, profile=name, stats=stats)
+            elapsed = stats.seconds["save"]
+            best = elapsed if best is None else min(best, elapsed)
+        stego = output
+        if profile.format == "RAW":
+            stego = stego_core.RawImage(output, width, height, mode)
+        if stego_core.decode_image(stego) != data:
+            raise AssertionError(f"{name} did not round trip {cover}")
+        size = os.path.getsize(output)
+        results.append({
+            "cover": os.path.basename(cover),
+            "profile": name,
+            "save_seconds": round(best, 4),
+            "file_mb": round(size / 1e6, 3),
+            "ratio": round(size / raw_bytes, 3),
+            "save_mb_s": round(raw_bytes / 1e6 / best, 1),
+        })
+    return results
+
+def print_table(results):
+    print(f"{'cover':<24}{'profile':<14}{'save s':>9}{'file MB':>10}{'ratio':>8}{'MB/s':>9}")
+    for row in results:
+        print(f"{row['cover']:<24}{row['profile']:<14}{row['save_seconds']:>9.3f}{row['file_mb']:>10.3f}"
+              f"{row['ratio']:>8.3f}{row['save_mb_s']:>9.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Save time versus file size of stego_core output profiles.")
+    parser.add_argument("--covers", nargs="+", help="cover images (default: synthetic covers)")
+    parser.add_argument("--megapixels", nargs="+", type=float, default=DEFAULT_MEGAPIXELS,
+                        help="sizes of the synthetic covers (default: %(default)s)")
+    parser.add_argument("--profiles", nargs="+", default=list(stego_core.OUTPUT_PROFILES),
+                        help="profiles to compare (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="saves per profile; the fastest counts")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "stego-bench"),
+                        help="where synthetic covers are kept between runs")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    covers = args.covers
+    if not covers:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        covers = [ensure_cover(megapixels, args.cache_dir) for megapixels in args.megapixels]
+
+    results = []
+    with tempfile.TemporaryDirectory() as work:
+        for cover in covers:
+            results.extend(run_cover(cover, args.profiles, args.repeat, work))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""Startup benchmarks: import time of the headless modules and worker pool warm-up.
+
+    python benchmarks/bench_startup.py                 # compared with baseline.json
+    python benchmarks/bench_startup.py --save-baseline # record this machine's numbers
+
+Every measurement runs in a fresh interpreter, after the sources are
+byte-compiled, and the median of --repeat runs is kept. A case fails when it
+is slower than the baseline by more than the tolerance, or when importing a
+headless module loads a module it must not: the GUI toolkits ever, and NumPy
+or Pillow before the first pixel is touched.
+"""
+import argparse
+import compileall
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+GUI_MODULES = ("tkinter", "customtkinter")
+PIXEL_MODULES = ("numpy", "PIL")
+# Module to import, and the modules importing it must leave unloaded
+IMPORTS = {
+    "stego_core": GUI_MODULES + PIXEL_MODULES,
+    "stego_cli": GUI_MODULES + PIXEL_MODULES,
+    "stego_scan": GUI_MODULES + PIXEL_MODULES,
+    "stego_server": GUI_MODULES + PIXEL_MODULES,
+    "stego_library": GUI_MODULES + PIXEL_MODULES,
+}
+POOL_WORKERS = 2
+
+# Differences below this are noise whatever the tolerance says; an eager
+# NumPy or Pillow import shows up as a loaded module long before its time does
+MIN_SECONDS = 0.03
+
+_IMPORT_CASE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {forbidden!r} if name in sys.modules]}}))
+"""
+
+# Time from creating the last of pools pools to every worker having answered
+# a task that needs NumPy, as the first job of a batch or scan would. The
+# first pool of a process also starts the server its workers fork from.
+_POOL_CASE = """
+import json, time
+import stego_core
+for _ in range({pools}):
+    started = time.perf_counter()
+    with stego_core.worker_pool({workers}) as pool:
+        list(pool.map(stego_core.estimate_entropy, [b"warm"] * {workers}))
+        seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "loaded": []}}))
+"""
+
+def _child(args):
+    completed = subprocess.run([sys.executable] + args, capture_output=True, text=True, cwd=ROOT,
+                               env=dict(os.environ, PYTHONPATH=ROOT))
+    if completed.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{completed.stderr}")
+    return completed.stdout
+
+def measure_import(module, forbidden):
+    return json.loads(_child(["-c", _IMPORT_CASE.format(module=module, forbidden=forbidden)]))
+
+def measure_cli():
+    # The whole process: interpreter start, imports and argument parsing
+    started = time.perf_counter()
+    _child(["-m", "stego_core", "--help"])
+    return {"seconds": time.perf_counter() - started, "loaded": []}
+
+def measure_pool(pools, workers=POOL_WORKERS):
+    return json.loads(_child(["-c", _POOL_CASE.format(pools=pools, workers=workers)]))
+
+def iter_cases():
+    for module, forbidden in IMPORTS.items():
+        yield f"import-{module}", lambda module=module, forbidden=forbidden: measure_import(module, forbidden)
+    yield "cli-help", measure_cli
+    yield "pool-first", lambda: measure_pool(1)
+    yield "pool-again", lambda: measure_pool(2)
+
+def run_case(measure, repeat):
+    """The median time of repeat runs, and any forbidden modules they loaded"""
+    runs = [measure() for _ in range(repeat)]
+    loaded = sorted({name for run in runs for name in run["loaded"]})
+    return {"seconds": {"startup": round(statistics.median(run["seconds"] for run in runs), 4)}, "loaded": loaded}
+
+def compare(name, result, baseline, tolerance):
+    """List how result regressed against baseline"""
+    regressions = []
+    if result["loaded"]:
+        regressions.append(f"{name}: loads {', '.join(result['loaded'])}")
+    old = baseline.get("seconds", {}).get("startup")
+    new = result["seconds"]["startup"]
+    if old and new > old * (1 + tolerance) and new - old > MIN_SECONDS:
+        regressions.append(f"{name}: {new:.3f}s vs baseline {old:.3f}s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown (default 0.25)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case (default 5)")
+    parser.add_argument("--json", help="also write the raw results to this file")
+    args = parser.parse_args(argv)
+
+    # Time imports, not compiling them
+    compileall.compile_dir(ROOT, maxlevels=0, quiet=1)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'case':<24}{'seconds':>10}  loaded")
+    for name, measure in iter_cases():
+        result = results[name] = run_case(measure, args.repeat)
+        print(f"{name:<24}{result['seconds']['startup']:>10.4f}  {', '.join(result['loaded']) or '-'}")
+        regressions.extend(compare(name, result, baseline.get(name, {}), args.tolerance))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} REGRESSION(S) against {args.baseline}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    if not any(name in baseline for name in results):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
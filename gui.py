@@ -2,15 +2,63 @@ import customtkinter as ctk
 from tkinter import filedialog, messagebox
 from PIL import Image
 import os
-import struct
+import shutil
+import tempfile
 import threading
 import queue
 import time
-from stego_core import encode_data_to_image, decode_data_from_image
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from stego_core import (encode_data_to_image, encode_stream_to_image, decode_stream_from_image,
+                        max_payload_size, probe, iter_chunks, BITS_PER_CHANNEL, MAX_BITS_PER_CHANNEL,
+                        TEXT_TYPE, file_type_prefix, COMPRESSION_POLICIES, DEFAULT_COMPRESSION,
+                        OUTPUT_PROFILES, DEFAULT_PROFILE, Cancelled, Stats)
 
-# Constants for data type identification
-TEXT_TYPE = b'TXT:'
-FILE_TYPE = b'FILE:'
+# Previews: how many images keep their thumbnail and metadata, how long the
+# image path and options must stay unchanged before one loads, and its size
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_DELAY_MS = 250
+PREVIEW_SIZE = (300, 300)
+
+ImagePreview = namedtuple('ImagePreview', 'thumbnail width height payload mode')
+
+class PreviewCache:
+    """Least recently used image previews, keyed by path, modification time and size"""
+
+    def __init__(self, size=PREVIEW_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, key):
+        preview = self.entries.get(key)
+        if preview is not None:
+            self.entries.move_to_end(key)
+        return preview
+
+    def put(self, key, preview):
+        self.entries[key] = preview
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def load_preview(path):
+    """Thumbnail and probe an image; runs on the preview thread, never the Tk one"""
+    with Image.open(path) as img:
+        width, height = img.size
+        mode = img.mode
+        # JPEGs can decode straight at a reduced scale
+        img.draft("RGB", PREVIEW_SIZE)
+        img.thumbnail(PREVIEW_SIZE, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    try:
+        payload = probe(path)
+    except ValueError:
+        payload = None
+    return ImagePreview(img, width, height, payload, mode)
 
 class StegoApp:
     def __init__(self, root):
@@ -27,10 +75,29 @@ class StegoApp:
         self.image_path = ctk.StringVar()
         self.image_path.trace_add("write", self.update_image_preview)
         self.file_path = ctk.StringVar()
+        self.bits_per_channel = ctk.StringVar(value=str(BITS_PER_CHANNEL))
+        self.bits_per_channel.trace_add("write", self.update_image_preview)
+        self.use_alpha = ctk.BooleanVar(value=False)
+        self.use_alpha.trace_add("write", self.update_image_preview)
+        self.compression = ctk.StringVar(value=DEFAULT_COMPRESSION.capitalize())
+        self.profile = ctk.StringVar(value=DEFAULT_PROFILE)
+        self.key = ctk.StringVar()
         self.status_text = ctk.StringVar(value="Ready")
         
-        # Image preview
+        # Image preview, loaded and cached off the Tk thread
         self.preview_image = None
+        self.preview_cache = PreviewCache()
+        self.preview_requests = queue.Queue()
+        self.preview_results = queue.Queue()
+        self.preview_pending = None
+        self.preview_key = None
+        self.previews_outstanding = 0
+        threading.Thread(target=self.preview_worker, daemon=True).start()
+        
+        # Progress of the running encode or decode, written by its worker thread
+        self.cancel_event = None
+        self.progress = (0, None)
+        self.progress_started = 0.0
         
         self.setup_ui()
         self.update_mode_display()
@@ -53,6 +120,12 @@ class StegoApp:
         status_frame = ctk.CTkFrame(self.main_container, height=30)
         status_frame.pack(fill="x", pady=(10, 0))
         ctk.CTkLabel(status_frame, textvariable=self.status_text).pack(side="left", padx=10)
+        
+        # Shown only while an encode or decode runs
+        self.cancel_button = ctk.CTkButton(status_frame, text="Cancel", width=80, command=self.cancel_task)
+        self.progress_text = ctk.StringVar(value="")
+        self.progress_label = ctk.CTkLabel(status_frame, textvariable=self.progress_text)
+        self.progress_bar = ctk.CTkProgressBar(status_frame, width=200)
     
     def setup_encode_tab(self):
         left_frame = ctk.CTkFrame(self.encode_tab)
@@ -144,6 +217,53 @@ class StegoApp:
             font=ctk.CTkFont(size=12, slant="italic")
         ).pack(anchor="w", pady=(5, 0))
         
+        # Embedding options
+        options_frame = ctk.CTkFrame(left_frame)
+        options_frame.pack(fill="x", padx=15, pady=(0, 5))
+        
+        ctk.CTkLabel(options_frame, text="Bits per channel:", font=ctk.CTkFont(size=13)).pack(side="left", padx=(0, 10))
+        
+        ctk.CTkOptionMenu(
+            options_frame,
+            variable=self.bits_per_channel,
+            values=[str(bits) for bits in range(1, MAX_BITS_PER_CHANNEL + 1)],
+            width=70,
+            font=ctk.CTkFont(size=13)
+        ).pack(side="left", padx=(0, 20))
+        
+        ctk.CTkCheckBox(
+            options_frame,
+            text="Use alpha channel",
+            variable=self.use_alpha,
+            font=ctk.CTkFont(size=13)
+        ).pack(side="left")
+        
+        compression_frame = ctk.CTkFrame(left_frame)
+        compression_frame.pack(fill="x", padx=15, pady=(0, 5))
+        
+        ctk.CTkLabel(compression_frame, text="Compression:", font=ctk.CTkFont(size=13)).pack(side="left", padx=(0, 10))
+        
+        ctk.CTkOptionMenu(
+            compression_frame,
+            variable=self.compression,
+            values=[policy.capitalize() for policy in COMPRESSION_POLICIES],
+            width=110,
+            font=ctk.CTkFont(size=13)
+        ).pack(side="left")
+        
+        ctk.CTkLabel(compression_frame, text="Output:", font=ctk.CTkFont(size=13)).pack(side="left", padx=(15, 10))
+        
+        ctk.CTkOptionMenu(
+            compression_frame,
+            variable=self.profile,
+            # Headerless raw output can't be opened again without its size
+            values=[name for name, profile in OUTPUT_PROFILES.items() if profile.format != "RAW"],
+            width=120,
+            font=ctk.CTkFont(size=13)
+        ).pack(side="left")
+        
+        self.add_key_entry(left_frame, "Key (optional, scatters the data):")
+        
         # Encode button
         encode_btn = ctk.CTkButton(
             left_frame, 
@@ -174,6 +294,13 @@ class StegoApp:
             font=ctk.CTkFont(size=12, slant="italic")
         ).pack(pady=(0, 10))
         
+    def add_key_entry(self, parent, text):
+        key_frame = ctk.CTkFrame(parent)
+        key_frame.pack(fill="x", padx=15, pady=(0, 5))
+        
+        ctk.CTkLabel(key_frame, text=text, font=ctk.CTkFont(size=13)).pack(side="left", padx=(0, 10))
+        ctk.CTkEntry(key_frame, textvariable=self.key, show="*", width=160).pack(side="left", fill="x", expand=True)
+    
     def setup_decode_tab(self):
         left_frame = ctk.CTkFrame(self.decode_tab)
         left_frame.pack(side="left", fill="both", expand=True, padx=(0, 5), pady=10)
@@ -204,6 +331,8 @@ class StegoApp:
         )
         browse_btn.pack(side="right")
         
+        self.add_key_entry(left_frame, "Key (if the data was hidden with one):")
+        
         output_label = ctk.CTkLabel(left_frame, text="Output will be detected automatically:", font=ctk.CTkFont(size=14))
         output_label.pack(anchor="w", padx=15, pady=(15, 5))
         
@@ -242,38 +371,90 @@ class StegoApp:
             self.file_frame.pack(fill="x", padx=15, pady=(0, 15), after=self.encode_tab.winfo_children()[0].winfo_children()[3])
     
     def update_image_preview(self, *args):
+        # Debounce: typing a path or changing options reloads once, after things settle
+        if self.preview_pending is not None:
+            self.root.after_cancel(self.preview_pending)
+        self.preview_pending = self.root.after(PREVIEW_DELAY_MS, self.show_image_preview)
+    
+    def show_image_preview(self):
+        self.preview_pending = None
         path = self.image_path.get()
-        if not path or not os.path.exists(path):
+        try:
+            self.preview_key = PreviewCache.key(path) if path else None
+        except OSError:
+            self.preview_key = None
+        if self.preview_key is None:
             # Clear preview
             self.preview_label.configure(text="No image selected", image=None)
             self.image_info.set("")
             return
-            
+        
+        preview = self.preview_cache.get(self.preview_key)
+        if preview is not None:
+            self.display_preview(preview)
+            return
+        
+        self.preview_label.configure(text="Loading preview...", image=None)
+        self.image_info.set("")
+        self.preview_requests.put((self.preview_key, path))
+        self.previews_outstanding += 1
+        if self.previews_outstanding == 1:
+            self.root.after(50, self.check_previews)
+    
+    def preview_worker(self):
+        while True:
+            key, path = self.preview_requests.get()
+            # Only the newest request is worth loading; answer the rest as skipped
+            while not self.preview_requests.empty():
+                self.preview_results.put((key, None))
+                key, path = self.preview_requests.get()
+            try:
+                self.preview_results.put((key, load_preview(path)))
+            except Exception as e:
+                self.preview_results.put((key, e))
+    
+    def check_previews(self):
+        while True:
+            try:
+                key, result = self.preview_results.get_nowait()
+            except queue.Empty:
+                break
+            self.previews_outstanding -= 1
+            if isinstance(result, ImagePreview):
+                self.preview_cache.put(key, result)
+            if key != self.preview_key or result is None:
+                continue
+            if isinstance(result, ImagePreview):
+                self.display_preview(result)
+            else:
+                self.preview_label.configure(text=f"Error loading image: {str(result)}", image=None)
+                self.image_info.set("")
+        if self.previews_outstanding:
+            self.root.after(50, self.check_previews)
+    
+    def display_preview(self, preview):
+        # Calculate capacity with the selected embedding options
+        bits = int(self.bits_per_channel.get())
         try:
-            # Load and resize image for preview
-            img = Image.open(path)
-            width, height = img.size
-            
-            # Calculate capacity
-            max_bytes = (width * height * 3 * 2) // 8
-            
-            # Update image info
-            self.image_info.set(f"Size: {width}x{height} pixels | Max capacity: {max_bytes/1024:.1f} KB")
-            
-            # Create preview
-            max_width, max_height = 300, 300
-            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-            self.preview_image = ctk.CTkImage(light_image=img, dark_image=img, 
-                                             size=(img.width, img.height))
-            
-            self.preview_label.configure(text="", image=self.preview_image)
-            
-        except Exception as e:
-            self.preview_label.configure(text=f"Error loading image: {str(e)}", image=None)
-            self.image_info.set("")
+            max_bytes = max_payload_size(preview.width, preview.height, bits, self.use_alpha.get(), preview.mode)
+        except ValueError:
+            # No alpha channel to embed in (16-bit greyscale)
+            max_bytes = max_payload_size(preview.width, preview.height, bits, False, preview.mode)
+        
+        # Update image info, noting a hidden payload found from the header alone
+        info = f"Size: {preview.width}x{preview.height} {preview.mode} pixels | Max capacity: {max_bytes/1024:.1f} KB"
+        if preview.payload:
+            info += f"\nContains hidden {preview.payload.kind} data ({preview.payload.payload_size/1024:.1f} KB, {preview.payload.codec})"
+            if preview.payload.keyed:
+                info += " - needs its key to decode"
+        self.image_info.set(info)
+        
+        self.preview_image = ctk.CTkImage(light_image=preview.thumbnail, dark_image=preview.thumbnail,
+                                         size=preview.thumbnail.size)
+        self.preview_label.configure(text="", image=self.preview_image)
     
     def browse_image(self):
-        path = filedialog.askopenfilename(filetypes=[("PNG images", "*.png")])
+        path = filedialog.askopenfilename(filetypes=[("Images", "*.png *.webp *.tif *.tiff *.bmp *.ppm"), ("All files", "*.*")])
         if path:
             self.image_path.set(path)
     
@@ -298,6 +479,47 @@ class StegoApp:
         self.status_text.set(message)
         self.root.update_idletasks()
     
+    def stats_status(self, done, stats):
+        # e.g. "Encoded in 1.20s: decode 0.40s, embed 0.10s, save 0.70s"
+        elapsed = time.perf_counter() - self.progress_started
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stats.seconds.items() if seconds >= 0.005)
+        self.update_status(f"{done} in {elapsed:.2f}s" + (f": {stages}" if stages else ""))
+    
+    def start_progress(self):
+        self.cancel_event = threading.Event()
+        self.progress = (0, None)
+        self.progress_started = time.perf_counter()
+        self.progress_bar.set(0)
+        self.progress_text.set("")
+        self.cancel_button.pack(side="right", padx=10)
+        self.progress_label.pack(side="right", padx=10)
+        self.progress_bar.pack(side="right", padx=10)
+        return self.cancel_event
+    
+    def report_progress(self, done, total):
+        # Called on the worker thread: only record it, the Tk thread draws it
+        self.progress = (done, total)
+    
+    def show_progress(self):
+        done, total = self.progress
+        elapsed = max(time.perf_counter() - self.progress_started, 1e-6)
+        text = f"{done/1024/1024:.1f} MB"
+        if total:
+            self.progress_bar.set(min(1.0, done / total))
+            text += f" of {total/1024/1024:.1f} MB"
+        self.progress_text.set(f"{text} ({done/1024/1024/elapsed:.1f} MB/s)")
+    
+    def stop_progress(self):
+        self.cancel_event = None
+        self.cancel_button.pack_forget()
+        self.progress_label.pack_forget()
+        self.progress_bar.pack_forget()
+    
+    def cancel_task(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.update_status("Cancelling...")
+    
     def encode(self):
         image = self.image_path.get()
         if not image:
@@ -312,6 +534,8 @@ class StegoApp:
                 
             # Encode text with marker
             data = TEXT_TYPE + text.encode('utf-8')
+            data_size = len(data)
+            file_path = None
         else:
             file_path = self.file_path.get()
             if not os.path.isfile(file_path):
@@ -333,39 +557,53 @@ class StegoApp:
                     if not proceed:
                         return
                 
-                self.update_status(f"Reading file data...")
-                
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                
-                ext_bytes = file_ext.encode('utf-8')
-                ext_len = len(ext_bytes)
-                
-                # Pack the extension length as a 2-byte integer
-                ext_len_bytes = struct.pack('!H', ext_len)
-                
-                # Combine all parts
-                data = FILE_TYPE + ext_len_bytes + ext_bytes + file_data
+                # The file itself is streamed in after this prefix
+                data = file_type_prefix(file_ext)
+                data_size = len(data) + file_size
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to read file: {str(e)}")
                 return
 
-        # Ask where to save the encoded image
+        # Ask where to save the encoded image, in the format of the output profile
+        profile = self.profile.get()
+        output_format = OUTPUT_PROFILES[profile]
         output_path = filedialog.asksaveasfilename(
-            defaultextension=".png",
-            filetypes=[("PNG images", "*.png")]
+            defaultextension=output_format.extension,
+            filetypes=[(f"{output_format.format} images", f"*{output_format.extension}")]
         )
         
         if not output_path:
             return  # User cancelled
         result_queue = queue.Queue()
+        bits_per_channel = int(self.bits_per_channel.get())
+        use_alpha = self.use_alpha.get()
+        compression = self.compression.get().lower()
+        key = self.key.get() or None
         
         self.update_status("Encoding data... This may take a moment.")
+        cancel = self.start_progress()
+        stats = Stats()
+        
+        def progress(done, total):
+            # The streamed file's size is not known to the engine, but is here
+            self.report_progress(done, data_size)
         
         def encode_task():
             try:
-                encode_data_to_image(image, data, output_path, compress=True)
-                result_queue.put(("success", len(data), output_path))
+                if file_path is None:
+                    encode_data_to_image(image, data, output_path, compress=True,
+                                         bits_per_channel=bits_per_channel, use_alpha=use_alpha,
+                                         compression=compression, profile=profile,
+                                         progress=progress, cancel=cancel, stats=stats, key=key)
+                else:
+                    with open(file_path, 'rb') as f:
+                        encode_stream_to_image(image, chain([data], iter_chunks(f)), output_path, compress=True,
+                                               bits_per_channel=bits_per_channel, use_alpha=use_alpha,
+                                               compression=compression, profile=profile,
+                                               progress=progress, cancel=cancel, stats=stats, key=key)
+                result_queue.put(("success", data_size, output_path))
+            except Cancelled:
+                result_queue.put(("cancelled",))
             except Exception as e:
                 # Put error in queue
                 result_queue.put(("error", str(e)))
@@ -376,21 +614,26 @@ class StegoApp:
         def check_result():
             try:
                 result_type, *args = result_queue.get_nowait()
-                
-                if result_type == "success":
-                    data_size, output_path = args
-                    self.encoding_complete(data_size, output_path)
-                else:
-                    error_message = args[0]
-                    self.encoding_failed(error_message)
             except queue.Empty:
+                self.show_progress()
                 self.root.after(100, check_result)
+                return
+            
+            self.stop_progress()
+            if result_type == "success":
+                data_size, output_path = args
+                self.encoding_complete(data_size, output_path, stats)
+            elif result_type == "cancelled":
+                self.update_status("Encoding cancelled")
+            else:
+                error_message = args[0]
+                self.encoding_failed(error_message)
         
         # Start checking for results
         self.root.after(100, check_result)
     
-    def encoding_complete(self, data_size, output_path):
-        self.update_status("Ready")
+    def encoding_complete(self, data_size, output_path, stats):
+        self.stats_status("Encoded", stats)
         messagebox.showinfo(
             "Success", 
             f"Data encoded successfully!\n\n"
@@ -409,16 +652,28 @@ class StegoApp:
             return
         
         result_queue = queue.Queue()
+        key = self.key.get() or None
         
         self.update_status("Decoding data... This may take a moment.")
+        cancel = self.start_progress()
+        stats = Stats()
         
         def decode_task():
+            temp_path = None
             try:
-                # Decode data from the image
-                decoded_data = decode_data_from_image(image)
-                result_queue.put(("success", decoded_data))
+                # Stream the payload into a temporary file rather than memory
+                with tempfile.NamedTemporaryFile(suffix=".part", delete=False) as tmp:
+                    temp_path = tmp.name
+                    payload = decode_stream_from_image(image, tmp, progress=self.report_progress,
+                                                       cancel=cancel, stats=stats, key=key)
+                result_queue.put(("success", payload, temp_path))
             except Exception as e:
-                result_queue.put(("error", str(e)))
+                if temp_path:
+                    os.remove(temp_path)
+                if isinstance(e, Cancelled):
+                    result_queue.put(("cancelled",))
+                else:
+                    result_queue.put(("error", str(e)))
         
         decoding_thread = threading.Thread(target=decode_task, daemon=True)
         decoding_thread.start()
@@ -426,84 +681,63 @@ class StegoApp:
         def check_result():
             try:
                 result_type, *args = result_queue.get_nowait()
-                
-                if result_type == "success":
-                    decoded_data = args[0]
-                    self.process_decoded_data(decoded_data)
-                else:
-                    error_message = args[0]
-                    self.decoding_failed(error_message)
             except queue.Empty:
+                self.show_progress()
                 self.root.after(100, check_result)
+                return
+            
+            self.stop_progress()
+            if result_type == "success":
+                payload, temp_path = args
+                self.process_decoded_data(payload, temp_path, stats)
+            elif result_type == "cancelled":
+                self.update_status("Decoding cancelled")
+            else:
+                error_message = args[0]
+                self.decoding_failed(error_message)
         self.root.after(100, check_result)
     
-    def process_decoded_data(self, decoded_data):
-        self.update_status("Ready")
+    def process_decoded_data(self, payload, temp_path, stats):
+        self.stats_status("Decoded", stats)
         
         try:
-            if decoded_data.startswith(TEXT_TYPE):
-                text = decoded_data[len(TEXT_TYPE):].decode('utf-8', errors='replace')
+            if payload.kind == "text":
+                with open(temp_path, 'rb') as f:
+                    text = f.read().decode('utf-8', errors='replace')
                 
                 # Create a custom dialog for displaying the text
                 self.show_text_dialog("Decoded Message", text)
                 
             # Check if it's file data
-            elif decoded_data.startswith(FILE_TYPE):
-                file_data = decoded_data[len(FILE_TYPE):]
+            elif payload.kind == "file":
+                # Ask where to save the decoded file
+                save_path = filedialog.asksaveasfilename(
+                    defaultextension=payload.extension,
+                    filetypes=[("All files", "*.*")]
+                )
                 
-                try:
-                    ext_len = struct.unpack('!H', file_data[:2])[0]
-                    
-                    ext = file_data[2:2+ext_len].decode('utf-8', errors='replace')
-                    
-                    content = file_data[2+ext_len:]
-                    
-                    # Ask where to save the decoded file
-                    save_path = filedialog.asksaveasfilename(
-                        defaultextension=ext,
-                        filetypes=[("All files", "*.*")]
+                if save_path:
+                    # Move the decoded file into place
+                    shutil.move(temp_path, save_path)
+                    messagebox.showinfo(
+                        "Success", 
+                        f"File decoded successfully!\n\n"
+                        f"Saved to: {os.path.basename(save_path)}\n"
+                        f"File size: {payload.size/1024:.2f} KB"
                     )
-                    
-                    if save_path:
-                        # Save the decoded file
-                        with open(save_path, 'wb') as f:
-                            f.write(content)
-                        messagebox.showinfo(
-                            "Success", 
-                            f"File decoded successfully!\n\n"
-                            f"Saved to: {os.path.basename(save_path)}\n"
-                            f"File size: {len(content)/1024:.2f} KB"
-                        )
-                except (struct.error, IndexError, UnicodeDecodeError) as e:
-                    messagebox.showerror("Decoding Error", f"Failed to process file data: {str(e)}")
-                    self.update_status("Decoding failed")
             
             # Unknown data format fallback
             else:
-                try:
-                    # Decode as plain text
-                    text = decoded_data.decode('utf-8', errors='replace')
-                    self.show_text_dialog("Decoded Message (Legacy Format)", text)
-                except UnicodeDecodeError:
-                    # Ask where to save as binary
-                    save_path = filedialog.asksaveasfilename(
-                        title="Save decoded binary data",
-                        filetypes=[("All files", "*.*")]
-                    )
-                    
-                    if save_path:
-                        with open(save_path, 'wb') as f:
-                            f.write(decoded_data)
-                        messagebox.showinfo(
-                            "Success", 
-                            f"Binary data decoded successfully!\n\n"
-                            f"Saved to: {os.path.basename(save_path)}\n"
-                            f"Data size: {len(decoded_data)/1024:.2f} KB"
-                        )
+                with open(temp_path, 'rb') as f:
+                    text = f.read().decode('utf-8', errors='replace')
+                self.show_text_dialog("Decoded Message (Legacy Format)", text)
                         
         except Exception as e:
             messagebox.showerror("Error", f"Failed to process decoded data: {str(e)}")
             self.update_status("Processing failed")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
     
     def decoding_failed(self, error_message):
         self.update_status("Ready")
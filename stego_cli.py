@@ -0,0 +1,408 @@
+"""Headless command line interface: python -m stego_core {encode,decode,batch,serve,scan,library}"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import chain, count
+from stego_core import (encode_data_to_image, encode_stream_to_image, decode_stream_from_image,
+                        encode_archive, list_entries, iter_entry, iter_chunks, file_type_prefix, safe_extension, body_size,
+                        TEXT_TYPE, KEY_CHECK_SIZE, BITS_PER_CHANNEL,
+                        COMPRESSION_POLICIES, DEFAULT_COMPRESSION, OUTPUT_PROFILES, DEFAULT_PROFILE, RawImage, Stats,
+                        worker_pool)
+
+def encode_job(cover, output, text=None, file=None, compress=True,
+               bits_per_channel=BITS_PER_CHANNEL, use_alpha=False, compression=DEFAULT_COMPRESSION,
+               profile=DEFAULT_PROFILE, stats=None, key=None, workers=None, archive=None):
+    """Hide a text message, a file or an archive of files in cover, returning the payload size in bytes"""
+    if [text, file, archive].count(None) != 2:
+        raise ValueError("Give exactly one of text, file or archive.")
+    if archive is not None:
+        # Entries are named after the files, without their directories
+        encode_archive(cover, [(os.path.basename(path), path) for path in archive], output, compress,
+                       bits_per_channel, use_alpha, compression, profile, stats=stats, key=key, workers=workers)
+        return sum(os.path.getsize(path) for path in archive)
+    if text is not None:
+        data = TEXT_TYPE + text.encode('utf-8')
+        encode_data_to_image(cover, data, output, compress, bits_per_channel, use_alpha, compression, profile,
+                             stats=stats, key=key, workers=workers)
+        return len(data)
+
+    prefix = file_type_prefix(os.path.splitext(file)[1])
+    with open(file, 'rb') as f:
+        encode_stream_to_image(cover, chain([prefix], iter_chunks(f)), output, compress,
+                               bits_per_channel, use_alpha, compression, profile, stats=stats, key=key,
+                               workers=workers)
+    return len(prefix) + os.path.getsize(file)
+
+def decode_job(image, output, stats=None, key=None, workers=None):
+    """Extract the payload of image into output, returning a DecodedPayload"""
+    return decode_stream_from_image(image, output, stats=stats, key=key, workers=workers)
+
+def _fields(job, *names):
+    # The values of the fields a job must have
+    for name in names:
+        if name not in job:
+            raise ValueError(f"Missing field {name!r}")
+    return [job[name] for name in names]
+
+def run_job(job, with_stats=False):
+    """Run one manifest entry and describe the outcome as a JSON-ready dict"""
+    result = {"id": job.get("id"), "op": job.get("op")}
+    stats = Stats() if with_stats or job.get("stats") else None
+    started = time.perf_counter()
+    try:
+        op = job.get("op")
+        if op == "encode":
+            result["bytes"] = encode_job(
+                *_fields(job, "cover", "output"),
+                text=job.get("text"),
+                file=job.get("file"),
+                archive=job.get("archive"),
+                compress=job.get("compress", True),
+                bits_per_channel=job.get("bits_per_channel", BITS_PER_CHANNEL),
+                use_alpha=job.get("use_alpha", False),
+                compression=job.get("compression", DEFAULT_COMPRESSION),
+                profile=job.get("profile", DEFAULT_PROFILE),
+                stats=stats,
+                key=job.get("key"),
+            )
+        elif op == "decode":
+            payload = decode_job(*_fields(job, "image", "output"), stats, job.get("key"))
+            result.update(bytes=payload.size, kind=payload.kind, extension=payload.extension)
+        else:
+            raise ValueError(f"Unknown op {op!r}")
+        result["status"] = "ok"
+    except Exception as e:
+        result.update(status="error", error=str(e))
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    if stats is not None:
+        result["stats"] = stats.as_dict()
+    return result
+
+class ManifestError(ValueError):
+    """A manifest line that is not a JSON job object"""
+
+    def __init__(self, number, message):
+        super().__init__(f"Manifest line {number}: {message}")
+        self.id = number
+
+def read_manifest(lines):
+    """Parse a JSON-lines manifest, skipping blank lines; bad lines come out as ManifestError instances"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            yield ManifestError(number, e)
+            continue
+        if not isinstance(job, dict):
+            yield ManifestError(number, f"expected a JSON object, got {type(job).__name__}")
+            continue
+        job.setdefault("id", number)
+        yield job
+
+def run_batch(jobs, out, workers=None, with_stats=False):
+    """Fan jobs out over a process pool, writing one JSON result line per job as it finishes.
+
+    At most a few jobs per worker are queued at a time, so manifests of any
+    length run in constant memory. With with_stats (or "stats": true on a
+    job) results carry per-stage timings and counters. A ManifestError in
+    place of a job gets an error result of its own. Returns the number of
+    failed jobs.
+    """
+    workers = workers or os.cpu_count() or 1
+    failures = 0
+    jobs = iter(jobs)
+
+    def report(result):
+        nonlocal failures
+        if result["status"] != "ok":
+            failures += 1
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    with worker_pool(workers) as pool:
+        pending = set()
+        while True:
+            for job in jobs:
+                if isinstance(job, ManifestError):
+                    report({"id": job.id, "op": None, "status": "error", "error": str(job)})
+                    continue
+                pending.add(pool.submit(run_job, job, with_stats))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                report(future.result())
+    return failures
+
+def raw_size(text):
+    """Parse a WIDTHxHEIGHT argument"""
+    try:
+        width, height = (int(part) for part in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive size, got {text!r}")
+    return width, height
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m stego_core", description="Hide and extract data in images.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    encode = commands.add_parser("encode", help="hide a message or file in a cover image")
+    encode.add_argument("cover", help="cover image")
+    encode.add_argument("output", help="image file to write")
+    payload = encode.add_mutually_exclusive_group(required=True)
+    payload.add_argument("--text", help="message to hide")
+    payload.add_argument("--file", help="file to hide")
+    payload.add_argument("--archive", nargs="+", metavar="FILE",
+                         help="files to hide as an archive, each of which can be extracted alone")
+    encode.add_argument("--bits", type=int, default=BITS_PER_CHANNEL, help="bits per channel (1-4)")
+    encode.add_argument("--alpha", action="store_true", help="also embed in the alpha channel (one is added to L and RGB covers)")
+    encode.add_argument("--no-compress", action="store_true", help="store the payload uncompressed")
+    encode.add_argument("--compression", choices=COMPRESSION_POLICIES, default=DEFAULT_COMPRESSION,
+                        help="trade CPU time for payload size (default: %(default)s)")
+    encode.add_argument("--profile", default=DEFAULT_PROFILE,
+                        help=f"output format: {', '.join(OUTPUT_PROFILES)} or png-0 to png-9 (default: %(default)s)")
+    encode.add_argument("--raw", type=raw_size, metavar="WIDTHxHEIGHT",
+                        help="the cover is headerless RGB pixel bytes of this size")
+    encode.add_argument("--key", help="scatter the payload over the image with this key; decoding needs it too")
+    encode.add_argument("-j", "--workers", type=int, default=None,
+                        help="embed large payloads tile by tile on this many processes (default: 1)")
+    encode.add_argument("--stats", action="store_true", help="print per-stage timings and counters")
+
+    decode = commands.add_parser("decode", help="extract the payload of an image")
+    decode.add_argument("image", help="image to decode")
+    decode.add_argument("-o", "--output", help="where to write the payload (default: stdout for text, "
+                                               "the image name with the hidden file's extension otherwise)")
+    decode.add_argument("--raw", type=raw_size, metavar="WIDTHxHEIGHT",
+                        help="the image is headerless RGB pixel bytes of this size")
+    entries = decode.add_mutually_exclusive_group()
+    entries.add_argument("--list", action="store_true", help="list the entries of an archive")
+    entries.add_argument("--entry", help="extract this entry of an archive (default output: its name, "
+                                         "next to the image)")
+    decode.add_argument("--key", help="key the payload was embedded with")
+    decode.add_argument("-j", "--workers", type=int, default=None,
+                        help="extract large payloads tile by tile on this many processes (default: 1)")
+    decode.add_argument("--stats", action="store_true", help="print per-stage timings and counters")
+
+    batch = commands.add_parser("batch", help="run a JSON-lines manifest of encode/decode jobs")
+    batch.add_argument("manifest", help="manifest file, or - for stdin")
+    batch.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    batch.add_argument("-r", "--results", help="write JSON-lines results here instead of stdout")
+    batch.add_argument("--stats", action="store_true", help="add per-stage timings and counters to every result")
+
+    serve = commands.add_parser("serve", help="run the HTTP encode/decode service")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=8080, help="port to listen on (default: %(default)s)")
+    serve.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    serve.add_argument("--queue", type=int, default=None,
+                       help="jobs that may wait for a worker before requests get 429 (default: 2 per worker)")
+    serve.add_argument("--max-body", type=int, default=64, help="largest request body in MiB (default: %(default)s)")
+
+    scan = commands.add_parser("scan", help="list the images under directories that carry a payload")
+    scan.add_argument("paths", nargs="+", help="directories or image files to scan")
+    scan.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    scan.add_argument("-r", "--results", help="write JSON-lines results here instead of stdout")
+    scan.add_argument("--index", help="JSON-lines index of earlier results; files unchanged since are skipped")
+    scan.add_argument("--ext", nargs="+", default=None,
+                      help="file extensions to look at in directories (default: .png .webp .tif .tiff .bmp .ppm)")
+    scan.add_argument("--payload-only", action="store_true", help="only report images that carry a payload")
+
+    library = commands.add_parser("library", help="index a library of covers and pick the best fit for a payload")
+    library_commands = library.add_subparsers(dest="library_command", required=True)
+    index = library_commands.add_parser("index", help="add or refresh the covers under directories")
+    index.add_argument("db", help="library database (SQLite), created if missing")
+    index.add_argument("paths", nargs="+", help="directories or image files to index")
+    index.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    index.add_argument("--ext", nargs="+", default=None,
+                       help="file extensions to look at in directories (default: .png .webp .tif .tiff .bmp .ppm)")
+    pick = library_commands.add_parser("pick", help="print the smallest indexed cover a payload fits in")
+    pick.add_argument("db", help="library database (SQLite)")
+    payload = pick.add_mutually_exclusive_group(required=True)
+    payload.add_argument("--text", help="message to hide")
+    payload.add_argument("--file", help="file to hide")
+    payload.add_argument("--bytes", type=int, help="bytes the payload takes up once compressed")
+    pick.add_argument("--bits", type=int, default=BITS_PER_CHANNEL, help="bits per channel (1-4)")
+    pick.add_argument("--alpha", action="store_true", help="also embed in the alpha channel")
+    pick.add_argument("--no-compress", action="store_true", help="the payload will be stored uncompressed")
+    pick.add_argument("--compression", choices=COMPRESSION_POLICIES, default=DEFAULT_COMPRESSION,
+                      help="compression policy the payload will be encoded with (default: %(default)s)")
+    pick.add_argument("--key", help="key the payload will be embedded with")
+    pick.add_argument("--min-texture", type=float, default=0.0,
+                      help="pass over covers smoother than this texture score, 0 to 255 (default: any)")
+    return parser
+
+def _new_path(stem, extension):
+    """Create an empty file named stem + extension, or stem.decoded + extension and so on if taken; return its path.
+
+    Names come from the payload, so an existing file, the image itself
+    included, is never taken over.
+    """
+    for n in count(1):
+        suffix = "" if n == 1 else ".decoded" if n == 2 else f".decoded-{n - 1}"
+        path = stem + suffix + extension
+        try:
+            open(path, 'xb').close()
+            return path
+        except FileExistsError:
+            continue
+
+def _temp_path(near):
+    # A new temporary file next to near, so the final rename stays on one file system
+    fd, path = tempfile.mkstemp(prefix=os.path.basename(near) + ".", suffix=".part",
+                                dir=os.path.dirname(os.path.abspath(near)))
+    os.close(fd)
+    return path
+
+def _decode_command(args, stats):
+    image = RawImage(args.image, *args.raw) if args.raw else args.image
+    if args.list:
+        for entry in list_entries(image, args.key, stats):
+            print(f"{entry.size:>12} {entry.stored_size:>12} {entry.codec:<5} {entry.name}")
+        return
+    if args.entry is not None:
+        temp_path = _temp_path(args.output or args.image)
+        size = 0
+        try:
+            with open(temp_path, 'wb') as out:
+                try:
+                    for chunk in iter_entry(image, args.entry, stats=stats, key=args.key):
+                        out.write(chunk)
+                        size += len(chunk)
+                except KeyError:
+                    raise ValueError(f"No entry named {args.entry!r} in the archive")
+            output = args.output
+            if output is None:
+                name = os.path.basename(args.entry.replace("\\", "/")).lstrip(".") or "entry"
+                output = _new_path(*os.path.splitext(os.path.join(os.path.dirname(args.image), name)))
+            os.replace(temp_path, output)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        print(f"Extracted {args.entry} ({size} bytes) to {output}", file=sys.stderr)
+        return
+    if args.output:
+        payload = decode_job(image, args.output, stats, args.key, args.workers)
+        print(f"Decoded {payload.kind} payload ({payload.size} bytes) to {args.output}", file=sys.stderr)
+        return
+
+    # No output given: stream into a temporary file next to the image, then
+    # print text or move the file to a new name after its hidden extension
+    temp_path = _temp_path(args.image)
+    try:
+        payload = decode_job(image, temp_path, stats, args.key, args.workers)
+        if payload.kind == "file":
+            output = _new_path(os.path.splitext(args.image)[0], safe_extension(payload.extension))
+            os.replace(temp_path, output)
+            print(f"Decoded file ({payload.size} bytes) to {output}", file=sys.stderr)
+        else:
+            with open(temp_path, 'rb') as f:
+                for chunk in iter_chunks(f):
+                    sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _scan_command(args):
+    from stego_scan import scan, ScanIndex, SCAN_EXTENSIONS
+    index = ScanIndex(args.index) if args.index else None
+    out = open(args.results, "w") if args.results else sys.stdout
+    totals = Counter()
+    try:
+        for record in scan(args.paths, index, args.workers, args.ext or SCAN_EXTENSIONS):
+            totals[record["status"]] += 1
+            totals["cached"] += record.get("cached", False)
+            if record["status"] != "payload" and args.payload_only:
+                continue
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        if index is not None:
+            index.close()
+        if out is not sys.stdout:
+            out.close()
+    scanned = totals["payload"] + totals["clean"] + totals["error"]
+    print(f"Scanned {scanned} images ({totals['cached']} unchanged since the last scan): "
+          f"{totals['payload']} with a payload, {totals['error']} unreadable", file=sys.stderr)
+
+def _library_command(args):
+    from stego_library import CoverLibrary
+    from stego_scan import SCAN_EXTENSIONS
+    with CoverLibrary(args.db) as library:
+        if args.library_command == "index":
+            totals = library.update(args.paths, args.workers, args.ext or SCAN_EXTENSIONS)
+            print(f"Indexed {len(library)} covers: {totals['added']} added, {totals['updated']} updated, "
+                  f"{totals['unchanged']} unchanged, {totals['removed']} removed, {totals['failed']} unreadable",
+                  file=sys.stderr)
+            return 0
+        if args.bytes is not None:
+            size = args.bytes + (KEY_CHECK_SIZE if args.key is not None else 0)
+        elif args.text is not None:
+            size = body_size(TEXT_TYPE + args.text.encode('utf-8'), not args.no_compress, args.compression, args.key)
+        else:
+            prefix = file_type_prefix(os.path.splitext(args.file)[1])
+            with open(args.file, 'rb') as f:
+                size = body_size(chain([prefix], iter_chunks(f)), not args.no_compress, args.compression, args.key)
+        cover = library.pick(size, args.bits, args.alpha, args.min_texture)
+    if cover is None:
+        print(f"Error: no indexed cover can carry {size} bytes at {args.bits} bits per channel", file=sys.stderr)
+        return 1
+    print(cover.path)
+    print(f"{cover.width}x{cover.height} {cover.mode}, texture {cover.texture:.1f}, payload {size} bytes",
+          file=sys.stderr)
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    stats = Stats() if getattr(args, "stats", False) and args.command != "batch" else None
+    try:
+        if args.command == "encode":
+            cover = RawImage(args.cover, *args.raw) if args.raw else args.cover
+            size = encode_job(cover, args.output, text=args.text, file=args.file, archive=args.archive,
+                              compress=not args.no_compress, bits_per_channel=args.bits,
+                              use_alpha=args.alpha, compression=args.compression, profile=args.profile,
+                              stats=stats, key=args.key, workers=args.workers)
+            print(f"Encoded {size} bytes into {args.output}", file=sys.stderr)
+        elif args.command == "decode":
+            _decode_command(args, stats)
+        elif args.command == "scan":
+            _scan_command(args)
+        elif args.command == "library":
+            return _library_command(args)
+        elif args.command == "serve":
+            from stego_server import serve
+            print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+            serve(args.host, args.port, args.workers, args.queue, args.max_body << 20)
+        else:
+            manifest = sys.stdin if args.manifest == "-" else open(args.manifest)
+            out = open(args.results, "w") if args.results else sys.stdout
+            try:
+                failures = run_batch(read_manifest(manifest), out, args.workers, args.stats)
+            finally:
+                if manifest is not sys.stdin:
+                    manifest.close()
+                if out is not sys.stdout:
+                    out.close()
+            if failures:
+                print(f"{failures} job(s) failed", file=sys.stderr)
+                return 1
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if stats is not None:
+        print(f"Stats: {stats.summary()}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
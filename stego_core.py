@@ -1,125 +1,1694 @@
-from PIL import Image
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from itertools import chain
+import bz2
+import hashlib
+import importlib
+import io
+import lzma
+import os
+import re
+import shutil
 import struct
+import tempfile
+import warnings
 import zlib
 import time
 
-# Using a binary EOF marker
+class _Deferred:
+    """A module that is imported the first time one of its attributes is used, and then bound in its place"""
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+# NumPy, Pillow and multiprocessing are most of the import time, and the CLI,
+# the scanner and the service's front process never touch pixels: load them
+# on first use
+np = _Deferred('numpy', 'np')
+Image = _Deferred('PIL.Image', 'Image')
+ImageMode = _Deferred('PIL.ImageMode', 'ImageMode')
+shared_memory = _Deferred('multiprocessing.shared_memory', 'shared_memory')
+
+# Using a binary EOF marker (legacy format, still recognised by the decoder)
 EOF_MARKER_BYTES = b'\xAA\xBB\xCC\xDD\xEE\xFF'
 
-# Number of bits to use per color channel 
+# Payload header (format v3): magic, format version, flags, bits per channel,
+# channel count, compression codec and payload length. It is always stored one bit per value in
+# the colour channels of the first pixels, so it can be read before the
+# decoder knows the bit depth or whether alpha is used. The payload starts on
+# the next whole pixel and uses the depth and channels recorded here.
+HEADER_MAGIC = b'\x89STG'
+FORMAT_VERSION = 3
+# Flags: what kind of payload follows (see TEXT_TYPE and FILE_TYPE), so a
+# probe can tell without decompressing anything
+FLAG_TEXT = 0x01
+FLAG_FILE = 0x02
+# The body is scattered over the image by a keyed permutation (see encode_image)
+FLAG_KEYED = 0x04
+# The body is an archive of named entries (see encode_archive)
+FLAG_ARCHIVE = 0x08
+_HEADER = struct.Struct('!4sBBBBBQ')
+HEADER_SIZE = _HEADER.size
+HEADER_BITS = HEADER_SIZE * 8
+
+# Format v2 was written in three layouts, all still decoded: first magic,
+# version, a compressed flag and the length, with the body right after it at
+# one bit per RGB value; then bits per channel and channel count were added,
+# the body moving to the next whole pixel; the third is the one v3 keeps.
+FORMAT_V2 = 2
+_HEADER_V2_FIRST = struct.Struct('!4sBBQ')
+_HEADER_V2_SECOND = struct.Struct('!4sBBBBQ')
+_V2_COMPRESSED = 0x01
+# Stored bytes of an older v2 payload read to find its type prefix
+V2_PEEK_BYTES = 256
+
+# body_start is the flat index of the first body value in the first two v2
+# layouts; None means right after the header pixels
+PayloadHeader = namedtuple('PayloadHeader',
+                           'version flags bits_per_channel channels codec payload_size mode body_start',
+                           defaults=(None,))
+
+# Compression codecs, recorded in the header so the decoder never has to guess
+CODEC_STORE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+CODEC_NAMES = {CODEC_STORE: 'store', CODEC_ZLIB: 'zlib', CODEC_BZ2: 'bz2', CODEC_LZMA: 'lzma'}
+CODEC_IDS = {name: codec for codec, name in CODEC_NAMES.items()}
+
+# Archive bodies start with an index: its length in bytes and the entry
+# count, then per entry the offset of its data past the index, its stored
+# and original sizes, codec, CRC-32 of the original bytes and the length of
+# its UTF-8 name, which follows. Entries are compressed one by one, so any
+# of them can be read back alone.
+_ARCHIVE_INDEX = struct.Struct('!II')
+_ARCHIVE_ENTRY = struct.Struct('!QQQBIH')
+# Compressed entries are held in memory up to this size, then on disk
+ARCHIVE_SPOOL_BYTES = 1 << 24
+
+# Compression policies: how much CPU to spend for a smaller payload
+COMPRESSION_POLICIES = ('speed', 'balanced', 'size')
+DEFAULT_COMPRESSION = 'balanced'
+
+# Samples at or above this many bits of entropy per byte (JPEG, ZIP, MP4...)
+# will not shrink, so they are stored as is
+INCOMPRESSIBLE_ENTROPY = 7.5
+SAMPLE_SIZE = 1 << 16
+
+# Number of bits to use per color channel (1-4)
 BITS_PER_CHANNEL = 1
+MAX_BITS_PER_CHANNEL = 4
+
+# Channel layouts: RGB, or RGBA when the alpha channel also carries data
+COLOR_CHANNELS = 3
+ALPHA_CHANNELS = 4
+
+# Modes covers are embedded in as they are: band count, colour band count
+# and sample type. Alpha, where there is one, is the last band; the colour
+# bands carry the payload, and alpha too when asked. Other modes are
+# converted to RGB or RGBA.
+PixelMode = namedtuple('PixelMode', 'bands colors dtype')
+PIXEL_MODES = {
+    'L': PixelMode(1, 1, 'uint8'),
+    'LA': PixelMode(2, 1, 'uint8'),
+    'RGB': PixelMode(3, 3, 'uint8'),
+    'RGBA': PixelMode(4, 3, 'uint8'),
+    'I;16': PixelMode(1, 1, 'uint16'),
+}
+# Mode codes for the high nibble of the header's channel byte. RGB with 3
+# channels and RGBA with 4 leave it zero, as format v2 always wrote them.
+MODE_CODES = {'L': 1, 'LA': 2, 'RGB': 3, 'RGBA': 4, 'I;16': 5}
+MODE_NAMES = {code: mode for mode, code in MODE_CODES.items()}
+
+# Streaming: size of the chunks read from file sources, and the amount of
+# pixel data the engines load and rewrite at a time
+CHUNK_SIZE = 1 << 16
+STRIP_BYTES = 1 << 20
+
+# Keyed embedding: rounds of the Feistel network that permutes body values,
+# and the bytes of key check stored at the start of a keyed body so a wrong
+# key is caught before any payload comes out
+FEISTEL_ROUNDS = 6
+KEY_CHECK_SIZE = 4
+
+# Tile-parallel embedding and extraction: bodies smaller than this are not
+# worth starting worker processes for, and each worker gets a few tiles so a
+# slow one does not hold up the rest
+PARALLEL_MIN_BYTES = 1 << 20
+TILES_PER_WORKER = 4
+
+# Worker pools fork their processes from a server that has imported these
+# once, where the platform allows it
+WORKER_PRELOAD = ('numpy', 'PIL.Image', 'stego_core')
+
+# Covers that are plain 8-bit PNGs are written back by splicing the changed
+# rows into the original file
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Constants for data type identification. A payload is either TXT: followed
+# by UTF-8 text, or FILE: followed by a 2-byte extension length, the
+# extension and the file content.
+TEXT_TYPE = b'TXT:'
+FILE_TYPE = b'FILE:'
+
+DecodedPayload = namedtuple('DecodedPayload', 'kind extension size')
+PayloadInfo = namedtuple('PayloadInfo', 'version codec bits_per_channel channels payload_size kind keyed mode')
+ArchiveEntry = namedtuple('ArchiveEntry', 'name size stored_size codec crc offset')
+OutputProfile = namedtuple('OutputProfile', 'format extension options')
+# A headerless file of 8-bit RGB or RGBA pixels, row by row from the top,
+# starting offset bytes in
+RawImage = namedtuple('RawImage', 'path width height mode offset', defaults=('RGB', 0))
+
+# How the stego image is saved: a lossless format and the Pillow options it
+# is saved with. PNG levels are zlib's 0-9 (any of png-0 to png-9 also
+# works) and compress_type is the zlib strategy. Lossless WebP keeps exact
+# colour values under transparent pixels. BMP, PPM and raw (headerless, see
+# RawImage) covers saved in their own format only have their changed rows
+# written.
+OUTPUT_PROFILES = {
+    'png': OutputProfile('PNG', '.png', {'compress_level': 6}),
+    'png-fast': OutputProfile('PNG', '.png', {'compress_level': 1}),
+    'png-store': OutputProfile('PNG', '.png', {'compress_level': 0}),
+    'png-small': OutputProfile('PNG', '.png', {'compress_level': 9}),
+    'png-rle': OutputProfile('PNG', '.png', {'compress_level': 6, 'compress_type': zlib.Z_RLE}),
+    'png-huffman': OutputProfile('PNG', '.png', {'compress_level': 6, 'compress_type': zlib.Z_HUFFMAN_ONLY}),
+    'webp': OutputProfile('WEBP', '.webp', {'lossless': True, 'quality': 100, 'method': 4, 'exact': True}),
+    'webp-fast': OutputProfile('WEBP', '.webp', {'lossless': True, 'quality': 0, 'method': 0, 'exact': True}),
+    'tiff': OutputProfile('TIFF', '.tif', {'compression': 'raw'}),
+    'tiff-deflate': OutputProfile('TIFF', '.tif', {'compression': 'tiff_adobe_deflate'}),
+    'bmp': OutputProfile('BMP', '.bmp', {}),
+    'ppm': OutputProfile('PPM', '.ppm', {}),
+    'raw': OutputProfile('RAW', '.rgb', {}),
+}
+DEFAULT_PROFILE = 'png'
+
+# Uncompressed pixel bytes that can be mapped as the channels of a mode: for
+# the mode and a Pillow raw mode, the bytes per pixel and the slice of them
+# that gives the mode's channels in order
+_RAW_LAYOUTS = {
+    ('L', 'L'): (1, slice(0, 1)),
+    ('RGB', 'RGB'): (3, slice(0, 3)),
+    ('RGB', 'BGR'): (3, slice(2, None, -1)),
+    ('RGB', 'RGBX'): (4, slice(0, 3)),
+    ('RGB', 'RGBA'): (4, slice(0, 3)),
+    ('RGB', 'BGRX'): (4, slice(2, None, -1)),
+    ('RGB', 'BGRA'): (4, slice(2, None, -1)),
+    ('RGBA', 'RGBA'): (4, slice(0, 4)),
+}
+
+def bytes_to_bits(data):
+    """Convert bytes to a uint8 array of bits, most significant bit first"""
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+def bits_to_bytes(bits):
+    """Pack a uint8 array of bits back into bytes, zero-padding the last byte"""
+    return np.packbits(bits).tobytes()
 
 def to_binary(data):
-    """Convert bytes to a binary string"""
-    return ''.join(f'{byte:08b}' for byte in data)
+    """Convert bytes to a binary string. Deprecated: use bytes_to_bits"""
+    warnings.warn("to_binary is deprecated, use bytes_to_bits", DeprecationWarning, stacklevel=2)
+    return (bytes_to_bits(data) + ord('0')).tobytes().decode('ascii')
 
 def from_binary(bin_str):
-    if len(bin_str) % 8 != 0:
-        bin_str = bin_str + '0' * (8 - (len(bin_str) % 8))
-    return bytes(int(bin_str[i:i+8], 2) for i in range(0, len(bin_str), 8))
+    """Convert a binary string back to bytes, zero-padding the last byte. Deprecated: use bits_to_bytes"""
+    warnings.warn("from_binary is deprecated, use bits_to_bytes", DeprecationWarning, stacklevel=2)
+    bits = np.frombuffer(bin_str.encode('ascii'), dtype=np.uint8) - ord('0')
+    if (bits > 1).any():
+        raise ValueError("A binary string may only hold 0 and 1.")
+    return bits_to_bytes(bits)
 
-def encode_data_to_image(image_path, data_bytes, output_path, compress=True):
-    if compress:
+def bits_to_values(bits, bits_per_channel):
+    """Group bits into bits_per_channel-wide values, one per channel, zero-padding the last"""
+    pad = -bits.size % bits_per_channel
+    if pad:
+        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
+    groups = bits.reshape(-1, bits_per_channel)
+    values = groups[:, 0].copy()
+    for i in range(1, bits_per_channel):
+        values <<= 1
+        values |= groups[:, i]
+    return values
+
+def values_to_bits(values, bits_per_channel):
+    """Split the low bits_per_channel bits of each value back into a bit array"""
+    shifts = np.arange(bits_per_channel - 1, -1, -1, dtype=np.uint8)
+    return ((values[:, None] >> shifts) & 1).reshape(-1)
+
+def embed_bits(channels, bits, bits_per_channel=BITS_PER_CHANNEL):
+    """Write bits into the low bits of the leading values of a flat uint8 or uint16 channel array, in place"""
+    values = bits_to_values(bits, bits_per_channel)
+    keep = channels.dtype.type(np.iinfo(channels.dtype).max ^ ((1 << bits_per_channel) - 1))
+    count = values.size
+    channels[:count] = (channels[:count] & keep) | values
+
+def extract_bits(channels, bit_count, bits_per_channel=BITS_PER_CHANNEL):
+    """Read bit_count bits back from the leading values of a flat channel array"""
+    count = -(-bit_count // bits_per_channel)
+    mask = np.uint8((1 << bits_per_channel) - 1)
+    return values_to_bits((channels[:count] & mask).astype(np.uint8, copy=False), bits_per_channel)[:bit_count]
+
+def header_pixels(image_channels, color_channels=COLOR_CHANNELS):
+    """Number of leading pixels reserved for the header"""
+    return -(-HEADER_BITS // min(image_channels, color_channels))
+
+def cover_mode(mode, use_alpha=False):
+    """The mode a cover of mode is embedded in, and how many channels of each pixel carry data.
+
+    Modes in PIXEL_MODES are kept; use_alpha adds an alpha band to L and
+    RGB covers. Anything else becomes RGB, or RGBA if it has alpha.
+    """
+    if mode not in PIXEL_MODES:
+        mode = "RGBA" if "A" in ImageMode.getmode(mode).bands else "RGB"
+    layout = PIXEL_MODES[mode]
+    if not use_alpha:
+        return mode, layout.colors
+    if layout.bands == layout.colors:
+        if mode + "A" not in PIXEL_MODES:
+            raise ValueError(f"{mode} covers have no alpha channel to embed in.")
+        mode += "A"
+    return mode, PIXEL_MODES[mode].bands
+
+def max_payload_size(width, height, bits_per_channel=BITS_PER_CHANNEL, use_alpha=False, mode="RGB"):
+    """Largest payload, in bytes, that fits in a width x height cover of mode"""
+    mode, channels = cover_mode(mode, use_alpha)
+    pixels = width * height - header_pixels(channels, PIXEL_MODES[mode].colors)
+    return max(0, pixels * channels * bits_per_channel // 8)
+
+def _check_bits_per_channel(bits_per_channel):
+    if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL:
+        raise ValueError(f"Bits per channel must be between 1 and {MAX_BITS_PER_CHANNEL}, got {bits_per_channel}")
+
+def pack_header(payload_size, flags=0, bits_per_channel=BITS_PER_CHANNEL, channels=COLOR_CHANNELS,
+                codec=CODEC_STORE, mode=None):
+    """Build a format v3 header for a payload of payload_size bytes in a cover of mode"""
+    layout = channels
+    if (mode, channels) not in ((None, COLOR_CHANNELS), (None, ALPHA_CHANNELS),
+                                ('RGB', COLOR_CHANNELS), ('RGBA', ALPHA_CHANNELS)):
+        layout |= MODE_CODES[mode] << 4
+    return _HEADER.pack(HEADER_MAGIC, FORMAT_VERSION, flags, bits_per_channel, layout, codec, payload_size)
+
+def unpack_header(header_bytes):
+    """Parse a header into a PayloadHeader, or return None if there is no magic.
+
+    A v2 header whose bytes fit two of its layouts is read in the later one;
+    decoders tell them apart by the body (see _read_header).
+    """
+    headers = _unpack_headers(header_bytes)
+    return headers[0] if headers else None
+
+def _unpack_headers(header_bytes):
+    # Every layout header_bytes can be read in, the latest first
+    magic, version = header_bytes[:4], header_bytes[4]
+    if magic != HEADER_MAGIC:
+        return []
+    if version == FORMAT_V2:
+        return _unpack_v2(header_bytes)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported payload format version {version}")
+    return [_unpack_current(header_bytes)]
+
+def _unpack_v2(header_bytes):
+    if header_bytes[6] == 0:
+        # Where the later layouts have bits per channel, the first has the
+        # top byte of the length
+        _, version, flags, payload_size = _HEADER_V2_FIRST.unpack(header_bytes[:_HEADER_V2_FIRST.size])
+        codec = CODEC_ZLIB if flags & _V2_COMPRESSED else CODEC_STORE
+        return [PayloadHeader(version, 0, 1, COLOR_CHANNELS, codec, payload_size, 'RGB', _HEADER_V2_FIRST.size * 8)]
+    headers = []
+    try:
+        headers.append(_unpack_current(header_bytes))
+    except ValueError:
+        pass
+    _, version, flags, bits_per_channel, channels, payload_size = _HEADER_V2_SECOND.unpack(
+        header_bytes[:_HEADER_V2_SECOND.size])
+    # Its length starts where the current layout has the codec
+    if (not flags & ~_V2_COMPRESSED and 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL
+            and channels in (COLOR_CHANNELS, ALPHA_CHANNELS) and header_bytes[8] == 0):
+        codec = CODEC_ZLIB if flags & _V2_COMPRESSED else CODEC_STORE
+        pixels = -(-_HEADER_V2_SECOND.size * 8 // COLOR_CHANNELS)
+        headers.append(PayloadHeader(version, 0, bits_per_channel, channels, codec, payload_size,
+                                     'RGBA' if channels == ALPHA_CHANNELS else 'RGB', pixels * channels))
+    if not headers:
+        raise ValueError("Corrupt header: invalid channel layout.")
+    return headers
+
+def _unpack_current(header_bytes):
+    _, version, flags, bits_per_channel, layout, codec, payload_size = _HEADER.unpack(header_bytes[:HEADER_SIZE])
+    channels = layout & 0x0F
+    mode = MODE_NAMES.get(layout >> 4) if layout >> 4 else "RGBA" if channels == ALPHA_CHANNELS else "RGB"
+    if (not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL or mode is None
+            or channels not in (PIXEL_MODES[mode].colors, PIXEL_MODES[mode].bands)):
+        raise ValueError("Corrupt header: invalid channel layout.")
+    if codec not in CODEC_NAMES:
+        raise ValueError(f"Unsupported compression codec {codec}")
+    return PayloadHeader(version, flags, bits_per_channel, channels, codec, payload_size, mode)
+
+def estimate_entropy(sample):
+    """Shannon entropy of a byte sample, in bits per byte"""
+    if not sample:
+        return 0.0
+    counts = np.bincount(np.frombuffer(sample, dtype=np.uint8), minlength=256)
+    probabilities = counts[counts > 0] / len(sample)
+    return float(-(probabilities * np.log2(probabilities)).sum())
+
+def _looks_like_text(sample):
+    data = np.frombuffer(sample, dtype=np.uint8)
+    printable = ((data >= 0x20) & (data < 0x7F)) | (data == 0x09) | (data == 0x0A) | (data == 0x0D)
+    return printable.mean() >= 0.95
+
+def choose_codec(sample, policy=DEFAULT_COMPRESSION):
+    """Pick (codec, level) for a payload from a sample of its bytes"""
+    if policy not in COMPRESSION_POLICIES:
+        raise ValueError(f"Compression policy must be one of {', '.join(COMPRESSION_POLICIES)}, got {policy!r}")
+    if not sample or estimate_entropy(sample) >= INCOMPRESSIBLE_ENTROPY:
+        return CODEC_STORE, 0
+    if policy == 'speed':
+        return CODEC_ZLIB, 1
+    if policy == 'balanced' or len(sample) < 4096:
+        # bz2 and lzma framing outweighs their gains on small payloads
+        return CODEC_ZLIB, 6 if policy == 'balanced' else 9
+    if _looks_like_text(sample):
+        return CODEC_BZ2, 9
+    return CODEC_LZMA, 6
+
+def _compressor(codec, level):
+    # All three expose the same compress()/flush() streaming interface
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(level)
+    if codec == CODEC_BZ2:
+        return bz2.BZ2Compressor(level)
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=level)
+    return None
+
+def _decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_BZ2:
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+def compress_bytes(data, codec, level):
+    """Compress a whole buffer with a codec chosen by choose_codec"""
+    compressor = _compressor(codec, level)
+    if compressor is None:
+        return data
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_bytes(data, codec):
+    """Reverse compress_bytes"""
+    if codec == CODEC_STORE:
+        return data
+    return b''.join(_inflate([data], codec))
+
+def output_profile(profile):
+    """Look up an output profile by name, or pass an OutputProfile through"""
+    if isinstance(profile, OutputProfile):
+        return profile
+    if profile in OUTPUT_PROFILES:
+        return OUTPUT_PROFILES[profile]
+    level = profile[len('png-'):] if isinstance(profile, str) and profile.startswith('png-') else ''
+    if len(level) == 1 and level.isdigit():
+        return OutputProfile('PNG', '.png', {'compress_level': int(level)})
+    raise ValueError(f"Output profile must be one of {', '.join(OUTPUT_PROFILES)} or png-0 to png-9, got {profile!r}")
+
+def _sample_source(source):
+    # Spread the sample over an in-memory payload; for a stream, peek at its
+    # head and hand back an iterator that still yields every chunk. Either
+    # way the sample starts with the first bytes of the payload.
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        if len(view) <= SAMPLE_SIZE:
+            return bytes(view), source
+        stripe = SAMPLE_SIZE // 16
+        step = (len(view) - stripe) // 15
+        return b''.join(view[i * step:i * step + stripe] for i in range(16)), source
+    chunks = iter_chunks(source)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= SAMPLE_SIZE:
+            break
+    return b''.join(head)[:SAMPLE_SIZE], chain(head, chunks)
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield the payload from bytes, a binary file object or an iterable of byte chunks"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield source
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+class Cancelled(Exception):
+    """Raised when the cancel token of an encode or decode is set"""
+
+def _source_size(source):
+    # Payload length when it can be known up front, else None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(memoryview(source).cast('B'))
+    try:
+        return os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled("Cancelled.")
+
+def _tracked(chunks, total, progress, cancel):
+    # Check the cancel token and report progress between chunks, cutting
+    # large chunks up so that both happen often
+    done = 0
+    for chunk in chunks:
+        view = memoryview(chunk).cast('B')
+        for start in range(0, len(view), CHUNK_SIZE):
+            _check_cancel(cancel)
+            piece = view[start:start + CHUNK_SIZE]
+            yield piece
+            done += len(piece)
+            if progress is not None:
+                progress(done, total)
+
+class Stats:
+    """Opt-in instrumentation: pass one as stats= to an encode or decode.
+
+    seconds holds the wall time of each stage that ran: 'open' (reading the
+    image header), 'decode' and 'convert' (cover pixels), 'compress',
+    'embed', 'save', 'extract' and 'decompress'. counts holds 'pixels'
+    touched, 'payload_bytes' before compression, 'stored_bytes' as embedded
+    and, when the output size is known, 'image_bytes'. A Stats can be reused
+    to add up several jobs. Without one the engines time nothing.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
         try:
-            data_bytes = zlib.compress(data_bytes, level=9)
-        except Exception as e:
-            print(f"Compression error: {e}")
-            # Continue without compression if it fails
-            pass
-        
-    data_with_marker = data_bytes + EOF_MARKER_BYTES
-    
-    img = Image.open(image_path).convert("RGB")
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - started
+
+    def count(self, name, amount):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def as_dict(self):
+        return {"seconds": {name: round(value, 6) for name, value in self.seconds.items()},
+                "counts": dict(self.counts)}
+
+    def summary(self):
+        """One line such as 'decode 0.120s, embed 0.031s, save 0.204s; pixels 1048576, ...'"""
+        stages = ", ".join(f"{name} {value:.3f}s" for name, value in self.seconds.items())
+        counts = ", ".join(f"{name} {value}" for name, value in self.counts.items())
+        return "; ".join(part for part in (stages, counts) if part)
+
+_NO_STAGE = nullcontext()
+
+def _stage(stats, name):
+    return _NO_STAGE if stats is None else stats.stage(name)
+
+def _timed(stats, name, func):
+    # func itself when instrumentation is off, so it costs nothing
+    if stats is None:
+        return func
+    def timed(*args):
+        with stats.stage(name):
+            return func(*args)
+    return timed
+
+def _key_bytes(key):
+    if isinstance(key, str):
+        return key.encode('utf-8')
+    return bytes(key)
+
+def key_check(key):
+    """The bytes a keyed body starts with, derived from the key alone"""
+    return hashlib.blake2b(_key_bytes(key), digest_size=KEY_CHECK_SIZE, person=b'stego-check').digest()
+
+def _mix(x, round_key):
+    # A splitmix64-style finaliser, on arrays of uint64 (the products wrap)
+    x = x ^ round_key
+    x *= np.uint64(0x9E3779B97F4A7C15)
+    x ^= x >> np.uint64(32)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(29)
+    return x
+
+class KeyedScatter:
+    """A keyed pseudo-random permutation of range(count), evaluated for any indices on demand.
+
+    A Feistel network permutes the smallest power-of-two domain that holds
+    count (unbalanced when its bit width is odd, the halves trading places
+    each round), and values that land past the end are walked through it
+    again until they fall inside (cycle walking), which keeps it a
+    permutation of range(count). Nothing is precomputed, so mapping n
+    indices costs O(n) time and memory whatever the count.
+    """
+
+    def __init__(self, key, count):
+        self.count = count
+        self.bits = max(2, (count - 1).bit_length())
+        digest = hashlib.blake2b(_key_bytes(key), digest_size=8 * FEISTEL_ROUNDS, person=b'stego-scatter').digest()
+        self.round_keys = np.frombuffer(digest, dtype='<u8').astype(np.uint64)
+
+    def _permute(self, x):
+        left_bits = self.bits - self.bits // 2
+        right_bits = self.bits // 2
+        left = x >> np.uint64(right_bits)
+        right = x & np.uint64((1 << right_bits) - 1)
+        for round_key in self.round_keys:
+            left, right = right, (left ^ _mix(right, round_key)) & np.uint64((1 << left_bits) - 1)
+            left_bits, right_bits = right_bits, left_bits
+        return (left << np.uint64(right_bits)) | right
+
+    def __call__(self, indices):
+        """Map an array of indices in range(count) to their places in the permutation"""
+        out = self._permute(np.asarray(indices, dtype=np.uint64))
+        outside = np.flatnonzero(out >= self.count)
+        while outside.size:
+            out[outside] = self._permute(out[outside])
+            outside = outside[out[outside] >= self.count]
+        return out.astype(np.intp)
+
+def _type_flags(head):
+    if head.startswith(TEXT_TYPE):
+        return FLAG_TEXT
+    if head.startswith(FILE_TYPE):
+        return FLAG_FILE
+    return 0
+
+def _payload_kind(flags):
+    if flags & FLAG_ARCHIVE:
+        return 'archive'
+    if flags & FLAG_TEXT:
+        return 'text'
+    if flags & FLAG_FILE:
+        return 'file'
+    return 'raw'
+
+def _plain_png(img):
+    # One tile, not interlaced: the decoder can be stopped after any row
+    return img.format == "PNG" and len(img.tile) == 1 and not img.info.get("interlace")
+
+def _can_load_top(img):
+    # Stopping a PNG decoder early leans on Pillow internals (tested with
+    # the range in requirements.txt): the size kept in _size, tiles of
+    # (codec, extents, offset, args) and the load_end hook. Without them the
+    # image is decoded in full.
+    return (_plain_png(img) and hasattr(img, '_size') and callable(getattr(img, 'load_end', None))
+            and len(img.tile[0]) == 4)
+
+def _load_top_rows(img, rows):
+    # Decode only the first rows of a freshly opened image. A plain PNG has
+    # its zlib decoder stopped after them; anything else is decoded in full
+    # and cropped. Returns None if this Pillow would not stop the decoder,
+    # leaving img unusable: open it again and decode it in full.
     width, height = img.size
-    
-    max_bytes = (width * height * 3 * BITS_PER_CHANNEL) // 8
-    data_size = len(data_with_marker)
-    
-    if data_size > max_bytes:
-        raise ValueError(f"Data too large ({data_size} bytes) for this image (max {max_bytes} bytes). Try using a larger image.")
-    
-    # Convert data to binary string
-    bin_data = to_binary(data_with_marker)
-    data_index = 0
-    modified = img.copy()
-    pixels = modified.load()
-    
-    mask = (1 << BITS_PER_CHANNEL) - 1
-    
-    for y in range(height):
-        for x in range(width):
-            r, g, b = pixels[x, y]
-            
-            if data_index < len(bin_data):
-                bit = int(bin_data[data_index])
-                r = (r & ~mask) | bit
-                data_index += 1
-            
-            if data_index < len(bin_data):
-                bit = int(bin_data[data_index])
-                g = (g & ~mask) | bit
-                data_index += 1
-            
-            if data_index < len(bin_data):
-                bit = int(bin_data[data_index])
-                b = (b & ~mask) | bit
-                data_index += 1
-                
-            pixels[x, y] = (r, g, b)
-            
-            if data_index >= len(bin_data):
+    if rows >= height:
+        img.load()
+        return img
+    if _can_load_top(img):
+        codec, _, offset, args = img.tile[0]
+        img._size = (width, rows)
+        img.tile = [(codec, (0, 0, width, rows), offset, args)]
+        # The file is left mid-IDAT, so skip the scan for trailing chunks
+        img.load_end = lambda: None
+        try:
+            img.load()
+        except Exception:
+            return None
+        if getattr(img.im, 'size', None) != (width, rows):
+            return None
+        return img
+    return img.crop((0, 0, width, rows))
+
+def _raw_layout(path, size, offset, args, mode):
+    # (offset, row stride, bottom-up, bytes per pixel, channel slice) of the
+    # pixel bytes of a file, if they can be mapped as the channels of mode.
+    # args are those of a Pillow raw tile: raw mode, stride and orientation.
+    layout = _RAW_LAYOUTS.get((mode, args[0]))
+    if layout is None:
+        return None
+    pixel_bytes, channels = layout
+    width, height = size
+    stride = (len(args) > 1 and args[1]) or width * pixel_bytes
+    if offset + stride * height > os.path.getsize(path):
+        return None
+    return offset, stride, len(args) > 2 and args[2] < 0, pixel_bytes, channels
+
+def _file_layout(img, path, mode):
+    # The raw layout of an uncompressed image file such as a BMP or PPM, or None
+    if len(img.tile) != 1 or img.mode not in ("L", "RGB", "RGBA"):
+        return None
+    codec, extents, offset, args = img.tile[0]
+    if codec != 'raw' or tuple(extents) != (0, 0) + img.size:
+        return None
+    return _raw_layout(path, img.size, offset, args if isinstance(args, tuple) else (args,), mode)
+
+def _array_in_mode(array, mode, copy):
+    # An (height, width, bands) array in mode, copied only when it has to be
+    bands = PIXEL_MODES[mode].bands
+    if array.shape[2] == bands:
+        return array.copy() if copy else array
+    if array.shape[2] > bands:
+        return np.ascontiguousarray(array[..., :bands])
+    alpha = np.full(array.shape[:2] + (1,), 255, dtype=array.dtype)
+    return np.concatenate([array, alpha], axis=2)
+
+def _array_mode(array):
+    # The mode of a cover array: uint8 with 1 to 4 bands, or one uint16 band
+    bands = array.shape[2] if array.ndim == 3 else 1
+    if array.ndim in (2, 3) and array.dtype == np.uint8 and 1 <= bands <= 4:
+        return ('L', 'LA', 'RGB', 'RGBA')[bands - 1]
+    if array.ndim in (2, 3) and array.dtype == np.uint16 and bands == 1:
+        return 'I;16'
+    raise ValueError("Cover arrays must be uint8 with shape (height, width) or (height, width, 1 to 4), "
+                     "or uint16 with shape (height, width).")
+
+def _rows_image(rows):
+    # A PIL image of (rows, width, bands) values; single bands become L or I;16
+    return Image.fromarray(rows[..., 0] if rows.shape[2] == 1 else rows)
+
+class _PixelStrips:
+    """Row-strip access to the channel values of a cover image, in raster order.
+
+    The cover is a path, a RawImage, encoded image bytes, a binary file
+    object, a PIL image or a NumPy array (see _array_mode). It is used in
+    its own mode, or in mode if given (see cover_mode); channels says how
+    many leading bands of each pixel carry data: all of them unless
+    use_alpha is False.
+    Rows are decoded the first time they are asked for: a plain PNG is only
+    ever decoded down to the deepest row used, other files in full.
+    Uncompressed files (BMP, PPM, raw) are memory-mapped instead, so only
+    the pages of the rows used are read; when writable, the mapping is
+    copy-on-write and changed rows are tracked in dirty. Images and arrays
+    are used as they are, and copied once only when writable is set.
+    Decoding, conversion and bit work are recorded in stats, if given.
+    """
+
+    def __init__(self, cover, mode=None, writable=False, stats=None, use_alpha=None):
+        self.stats = stats
+        self.scatter = self.body_offset = None
+        self.path = self.file = self.source = None
+        self.img = self.array = None
+        self.lazy = self.spliceable = False
+        self.format = self.layout = self.mapped = self.dirty = None
+        self.writable = writable
+        if isinstance(cover, RawImage):
+            self.path = cover.path
+            self.width, self.height = cover.width, cover.height
+            self.mode = mode or cover_mode(cover.mode, use_alpha)[0]
+            self.format = 'RAW'
+            if (self.mode, cover.mode) not in _RAW_LAYOUTS:
+                raise ValueError(f"A raw {cover.mode} cover can't be used as {self.mode}.")
+            self.layout = _raw_layout(cover.path, (cover.width, cover.height), cover.offset, (cover.mode,), self.mode)
+            if self.layout is None:
+                raise ValueError(f"{cover.path} is too small for {cover.width}x{cover.height} {cover.mode} pixels.")
+        elif isinstance(cover, np.ndarray):
+            native = _array_mode(cover)
+            self.source = cover if cover.ndim == 3 else cover[..., None]
+            self.height, self.width = cover.shape[:2]
+            self.mode = mode or cover_mode(native, use_alpha)[0]
+        elif isinstance(cover, Image.Image):
+            self.source = cover
+            self.width, self.height = cover.size
+            self.mode = mode or cover_mode(cover.mode, use_alpha)[0]
+        else:
+            if isinstance(cover, (str, os.PathLike)):
+                self.path = cover
+            elif isinstance(cover, (bytes, bytearray, memoryview)):
+                self.file = io.BytesIO(cover)
+            elif hasattr(cover, 'read'):
+                # Covers are reopened as rows are needed, so they must be seekable
+                self.file = cover if cover.seekable() else io.BytesIO(cover.read())
+            else:
+                raise TypeError(f"Unsupported cover type {type(cover).__name__}")
+            with self._open_image() as img:
+                self.width, self.height = img.size
+                self.mode = mode or cover_mode(img.mode, use_alpha)[0]
+                self.format = img.format
+                if self.path is not None:
+                    self.layout = _file_layout(img, self.path, self.mode)
+                self.lazy = _can_load_top(img)
+                # 8-bit pixels already in the target mode can be spliced back into the file
+                self.spliceable = _plain_png(img) and img.mode == self.mode and img.tile[0][3] == self.mode
+        self.bands, self.colors, self.dtype = PIXEL_MODES[self.mode]
+        self.use_channels(self.colors if use_alpha is False else self.bands)
+        self.strip_rows = max(1, STRIP_BYTES // (self.width * self.bands * np.dtype(self.dtype).itemsize))
+        # The decoded top of the image, and the original values of its last row
+        self.loaded = 0
+        self.edge = None
+
+    def use_channels(self, channels):
+        """Carry data in the first channels bands of each pixel"""
+        self.channels = channels
+        self.row_values = self.width * channels
+        self.value_count = self.row_values * self.height
+
+    def _open_image(self):
+        if self.path is not None:
+            return Image.open(self.path)
+        self.file.seek(0)
+        return Image.open(self.file)
+
+    def _open_file(self):
+        if self.path is not None:
+            return open(self.path, 'rb')
+        self.file.seek(0)
+        # Leave the caller's file open
+        return nullcontext(self.file)
+
+    def reserve(self, bottom):
+        """Make sure rows down to bottom are decoded, keeping any already changed"""
+        if bottom <= self.loaded:
+            return
+        if self.layout is not None:
+            with _stage(self.stats, 'decode'):
+                self.array = self._map()
+            self.loaded = self.height
+            return
+        if isinstance(self.source, np.ndarray):
+            with _stage(self.stats, 'convert'):
+                self.array = _array_in_mode(self.source, self.mode, self.writable)
+            self.loaded = self.height
+            return
+        if self.source is not None:
+            img = self.source
+            with _stage(self.stats, 'convert'):
+                if img.mode != self.mode:
+                    img = img.convert(self.mode)
+                elif self.writable:
+                    img = img.copy()
+            self.img = img
+            self.loaded = self.height
+            return
+
+        count = self.height
+        if self.lazy:
+            # Each redecode starts from the top, so grow geometrically
+            count = min(self.height, max(bottom, 2 * self.loaded))
+        with self._open_image() as img:
+            with _stage(self.stats, 'decode'):
+                top = _load_top_rows(img, count)
+            if top is not None and top.mode != self.mode:
+                with _stage(self.stats, 'convert'):
+                    top = top.convert(self.mode)
+        if top is None:
+            # The decoder could not be stopped early: decode in full from now on
+            self.lazy = False
+            self.reserve(bottom)
+            return
+        self.edge = np.array(top.crop((0, count - 1, self.width, count)), dtype=self.dtype).reshape(-1)
+        if self.img is not None:
+            top.paste(self.img, (0, 0))
+        self.img = top
+        self.loaded = count
+
+    def _map(self):
+        offset, stride, bottom_up, pixel_bytes, channels = self.layout
+        # Copy-on-write: changes stay in memory until the cover is saved
+        self.mapped = np.memmap(self.path, dtype=np.uint8, mode='c' if self.writable else 'r',
+                                offset=offset, shape=(self.height, stride))
+        rows = self.mapped[::-1] if bottom_up else self.mapped
+        rows = rows[:, :self.width * pixel_bytes].reshape(self.height, self.width, pixel_bytes)
+        return np.asarray(rows[..., channels])
+
+    def read_rows(self, top, bottom):
+        self.reserve(bottom)
+        if self.array is not None:
+            # A view whenever the array allows it, so writes land in place
+            return np.ascontiguousarray(self.array[top:bottom])
+        rows = np.array(self.img.crop((0, top, self.width, bottom)), dtype=self.dtype)
+        return rows.reshape(bottom - top, self.width, self.bands)
+
+    def write_rows(self, top, rows):
+        if self.mapped is not None:
+            bottom = top + len(rows)
+            self.dirty = (top, bottom) if self.dirty is None else (min(top, self.dirty[0]), max(bottom, self.dirty[1]))
+        if self.array is not None:
+            if not np.may_share_memory(rows, self.array):
+                self.array[top:top + len(rows)] = rows
+            return
+        self.img.paste(_rows_image(rows), (0, top))
+
+    def read_values(self, top, bottom):
+        """The values that carry data in rows top to bottom, flat; a view whenever the array allows it"""
+        rows = self.read_rows(top, bottom)
+        if self.channels == self.bands:
+            return rows.reshape(-1)
+        return rows[..., :self.channels].reshape(-1)
+
+    def write_values(self, top, values):
+        rows = values.reshape(-1, self.width, self.channels)
+        if self.channels != self.bands:
+            full = self.read_rows(top, top + len(rows))
+            full[..., :self.channels] = rows
+            rows = full
+        self.write_rows(top, rows)
+
+    def image(self):
+        """The whole cover, with any changes, as a PIL image"""
+        self.reserve(1)
+        if self.array is not None:
+            return _rows_image(self.array)
+        if self.loaded < self.height:
+            # Only the top was decoded: decode the rest now
+            with self._open_image() as img, _stage(self.stats, 'decode'):
+                full = img.convert(self.mode) if img.mode != self.mode else img.copy()
+            full.paste(self.img, (0, 0))
+            return full
+        return self.img
+
+    def flat(self):
+        """Every band value of the cover as one flat array; writes to it change the cover"""
+        self.reserve(self.height)
+        if self.array is None:
+            with _stage(self.stats, 'convert'):
+                self.array = np.array(self.img, dtype=self.dtype).reshape(self.height, self.width, self.bands)
+            self.img = None
+        elif self.mapped is not None:
+            # Scattered values lie all over the file: work on a copy, saved in full
+            with _stage(self.stats, 'convert'):
+                self.array = np.array(self.array)
+            self.mapped = None
+        return self.array.reshape(-1)
+
+    def scatter_body(self, key):
+        """Send the values from the body start on through a KeyedScatter of key"""
+        start = _body_start(self)
+        self.scatter = (start, KeyedScatter(key, max(1, self.value_count - start)))
+
+    def _scattered(self, start, count):
+        offset, permutation = self.scatter
+        index = offset + permutation(np.arange(start - offset, start - offset + count, dtype=np.uint64))
+        if self.channels != self.bands:
+            # From data values to band values, skipping the bands that carry nothing
+            index = index // self.channels * self.bands + index % self.channels
+        return index
+
+    def _span(self, start, count):
+        top = start // self.row_values
+        bottom = -(-(start + count) // self.row_values)
+        return top, bottom, start - top * self.row_values
+
+    def embed(self, start, bits, bits_per_channel):
+        """Write bits into the values starting at flat index start"""
+        count = -(-bits.size // bits_per_channel)
+        if self.scatter is not None:
+            values = self.flat()
+            with _stage(self.stats, 'embed'):
+                index = self._scattered(start, count)
+                chosen = values[index]
+                embed_bits(chosen, bits, bits_per_channel)
+                values[index] = chosen
+            self._touched(count)
+            return
+        top, bottom, offset = self._span(start, count)
+        self.reserve(bottom)
+        with _stage(self.stats, 'embed'):
+            values = self.read_values(top, bottom)
+            embed_bits(values[offset:], bits, bits_per_channel)
+            self.write_values(top, values)
+        self._touched(count)
+
+    def extract(self, start, bit_count, bits_per_channel):
+        """Read bit_count bits from the values starting at flat index start"""
+        count = -(-bit_count // bits_per_channel)
+        if self.scatter is not None:
+            values = self.flat()
+            with _stage(self.stats, 'extract'):
+                bits = extract_bits(values[self._scattered(start, count)], bit_count, bits_per_channel)
+            self._touched(count)
+            return bits
+        top, bottom, offset = self._span(start, count)
+        self.reserve(bottom)
+        with _stage(self.stats, 'extract'):
+            bits = extract_bits(self.read_values(top, bottom)[offset:], bit_count, bits_per_channel)
+        self._touched(count)
+        return bits
+
+    def _touched(self, value_count):
+        if self.stats is not None:
+            self.stats.count('pixels', -(-value_count // self.channels))
+
+def _png_chunks(f):
+    if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file.")
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            raise ValueError("Truncated PNG file.")
+        length, kind = struct.unpack('!I4s', head)
+        data = f.read(length)
+        f.read(4)
+        yield kind, data
+        if kind == b'IEND':
+            return
+
+def _png_chunk(kind, data):
+    return struct.pack('!I', len(data)) + kind + data + struct.pack('!I', zlib.crc32(data, zlib.crc32(kind)))
+
+def _unfilter_scanline(line, previous, bytes_per_pixel):
+    # Undo the filter of one PNG scanline, given the unfiltered row above it
+    kind = line[0]
+    raw = np.frombuffer(line, dtype=np.uint8, offset=1)
+    if kind == 0:
+        return raw.tobytes()
+    if kind == 1:
+        return np.cumsum(raw.reshape(-1, bytes_per_pixel), axis=0, dtype=np.uint8).tobytes()
+    if kind == 2:
+        return (raw + previous).tobytes()
+    if kind not in (3, 4):
+        raise ValueError(f"Corrupt PNG: unknown filter type {kind}.")
+    # Average and Paeth depend on the bytes just decoded, so go one by one
+    out = bytearray(raw.tobytes())
+    up = previous.tolist()
+    for i in range(len(out)):
+        left = out[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+        if kind == 3:
+            predictor = (left + up[i]) >> 1
+        else:
+            corner = up[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+            estimate = left + up[i] - corner
+            pa, pb, pc = abs(estimate - left), abs(estimate - up[i]), abs(estimate - corner)
+            predictor = left if pa <= pb and pa <= pc else up[i] if pb <= pc else corner
+        out[i] = (out[i] + predictor) & 0xFF
+    return bytes(out)
+
+def _spliced_scanlines(strips, idat):
+    # The decoded rows go out unfiltered. The rest of the original scanlines
+    # pass through as they are, except the first, whose filter may refer to
+    # a changed row above it.
+    stride = strips.width * strips.bands + 1
+    loaded = strips.loaded
+    for top in range(0, loaded, strips.strip_rows):
+        bottom = min(loaded, top + strips.strip_rows)
+        rows = strips.read_rows(top, bottom).reshape(-1, stride - 1)
+        yield np.hstack([np.zeros((len(rows), 1), dtype=np.uint8), rows]).tobytes()
+
+    skip = loaded * stride
+    edge = b'' if 0 < loaded < strips.height else None
+    inflater = zlib.decompressobj()
+    for data in idat:
+        while data:
+            try:
+                chunk = inflater.decompress(data, STRIP_BYTES)
+            except zlib.error as e:
+                raise ValueError(f"Corrupt PNG: {e}")
+            data = inflater.unconsumed_tail
+            if skip:
+                cut = min(skip, len(chunk))
+                chunk = chunk[cut:]
+                skip -= cut
+            if edge is not None and chunk:
+                edge += chunk
+                if len(edge) < stride:
+                    continue
+                yield b'\0' + _unfilter_scanline(edge[:stride], strips.edge, strips.bands)
+                chunk, edge = edge[stride:], None
+            if chunk:
+                yield chunk
+
+def _write_replacing(output, write):
+    # Have write(path) write a temporary file beside output, then move it over
+    # output: the output may be the cover itself, which is read while writing
+    temp_path = os.fspath(output) + ".part"
+    try:
+        write(temp_path)
+        os.replace(temp_path, output)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def _splice_png(strips, output, compress_level=zlib.Z_DEFAULT_COMPRESSION, strategy=zlib.Z_DEFAULT_STRATEGY,
+                cancel=None):
+    # Write the cover back without decoding the rows that were never touched:
+    # every chunk but IDAT is copied, and the image data is recompressed
+    # from the changed rows plus the original scanlines below them.
+    if not isinstance(output, (str, os.PathLike)):
+        _write_spliced_png(strips, output, compress_level, strategy, cancel)
+        return
+
+    def write(path):
+        with open(path, 'wb') as out:
+            _write_spliced_png(strips, out, compress_level, strategy, cancel)
+
+    _write_replacing(output, write)
+
+def _write_spliced_png(strips, out, compress_level, strategy, cancel):
+    with strips._open_file() as src:
+        out.write(PNG_SIGNATURE)
+        chunks = _png_chunks(src)
+        trailer = []
+        for kind, data in chunks:
+            if kind == b'IDAT':
                 break
-        if data_index >= len(bin_data):
-            break
-    
-    # Save the modified image
-    modified.save(output_path, "PNG")
+            out.write(_png_chunk(kind, data))
+
+        def idat():
+            yield data
+            for kind, chunk in chunks:
+                if kind != b'IDAT':
+                    trailer.append((kind, chunk))
+                    return
+                yield chunk
+
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy)
+        for scanlines in _spliced_scanlines(strips, idat()):
+            _check_cancel(cancel)
+            compressed = compressor.compress(scanlines)
+            if compressed:
+                out.write(_png_chunk(b'IDAT', compressed))
+        out.write(_png_chunk(b'IDAT', compressor.flush()))
+        for kind, data in chain(trailer, chunks):
+            out.write(_png_chunk(kind, data))
+
+def _write_mapped_rows(strips, path):
+    # The changed rows of a mapped cover, over the same rows of the file at path
+    if strips.dirty is None:
+        return
+    offset, stride, bottom_up, _, _ = strips.layout
+    top, bottom = strips.dirty
+    if bottom_up:
+        top, bottom = strips.height - bottom, strips.height - top
+    with open(path, 'r+b') as f:
+        f.seek(offset + top * stride)
+        for start in range(top, bottom, strips.strip_rows):
+            f.write(strips.mapped[start:min(bottom, start + strips.strip_rows)])
+
+def _save_mapped(strips, output, cancel=None):
+    # Write a mapped cover back by its changed rows alone: in place when
+    # output is the cover, otherwise into a copy of the cover's file
+    _check_cancel(cancel)
+    if os.path.exists(output) and os.path.samefile(output, strips.path):
+        _write_mapped_rows(strips, output)
+        return
+
+    def write(path):
+        shutil.copyfile(strips.path, path)
+        _write_mapped_rows(strips, path)
+
+    _write_replacing(output, write)
+
+def _write_raw(strips, out, cancel=None):
+    for top in range(0, strips.height, strips.strip_rows):
+        _check_cancel(cancel)
+        out.write(strips.read_rows(top, min(strips.height, top + strips.strip_rows)).tobytes())
+
+def _save_raw(strips, output, cancel=None):
+    # Headerless pixel bytes, strip by strip
+    if not isinstance(output, (str, os.PathLike)):
+        _write_raw(strips, output, cancel)
+        return
+
+    def write(path):
+        with open(path, 'wb') as out:
+            _write_raw(strips, out, cancel)
+
+    _write_replacing(output, write)
+
+def _save_cover(strips, output, profile=DEFAULT_PROFILE, cancel=None):
+    """Write the cover with its changed rows to output, a path or binary file object"""
+    profile = output_profile(profile)
+    if (profile.format == strips.format and strips.mapped is not None
+            and isinstance(output, (str, os.PathLike))):
+        with _stage(strips.stats, 'save'):
+            _save_mapped(strips, output, cancel)
+        return
+    if profile.format == "RAW":
+        with _stage(strips.stats, 'save'):
+            _save_raw(strips, output, cancel)
+        return
+    if profile.format == "PNG" and strips.spliceable:
+        with _stage(strips.stats, 'save'):
+            _splice_png(strips, output, profile.options.get('compress_level', zlib.Z_DEFAULT_COMPRESSION),
+                        profile.options.get('compress_type', zlib.Z_DEFAULT_STRATEGY), cancel)
+        return
+    image = strips.image()
+    with _stage(strips.stats, 'save'):
+        image.save(output, profile.format, **profile.options)
+
+def _header_rows(strips):
+    count = header_pixels(strips.colors, strips.colors)
+    return count, -(-count // strips.width)
+
+def _write_header(strips, header_bytes):
+    count, bottom = _header_rows(strips)
+    if bottom > strips.height:
+        raise ValueError("Image too small to hold the payload header.")
+    strips.reserve(bottom)
+    with _stage(strips.stats, 'embed'):
+        rows = strips.read_rows(0, bottom)
+        # The header skips alpha: one bit in each colour value of the first pixels
+        block = rows.reshape(-1, strips.bands)[:count, :strips.colors]
+        values = block.copy()
+        embed_bits(values.reshape(-1), bytes_to_bits(header_bytes), 1)
+        block[...] = values
+        strips.write_rows(0, rows)
+    strips._touched(count * strips.channels)
+
+def _read_header(strips):
+    count, bottom = _header_rows(strips)
+    if bottom > strips.height:
+        return None
+    strips.reserve(bottom)
+    with _stage(strips.stats, 'extract'):
+        rows = strips.read_rows(0, bottom)
+        block = rows.reshape(-1, strips.bands)[:count, :strips.colors].reshape(-1)
+        header_bytes = bits_to_bytes(extract_bits(block, HEADER_BITS, 1))
+    strips._touched(count * strips.channels)
+    headers = _unpack_headers(header_bytes)
+    if not headers:
+        return None
+    header = headers[0]
+    if len(headers) > 1:
+        # Text and file payloads of the current layout, and uncompressed ones
+        # of the second, start with their type prefix; failing that, the
+        # second layout's flag says compressed and the current one's says text
+        heads = [(candidate, _peek_body(strips, candidate, len(FILE_TYPE))) for candidate in headers]
+        heads = [(candidate, head) for candidate, head in heads if head is not None] or heads
+        prefixed = [candidate for candidate, head in heads if _type_flags(head or b'')]
+        candidates = [candidate for candidate, _ in heads]
+        header = (prefixed[0] if prefixed else
+                  candidates[-1] if candidates[-1].codec == CODEC_ZLIB else candidates[0])
+    if header.body_start is not None:
+        # The first v2 layouts have no type flags: look at the payload itself
+        head = _peek_body(strips, header, V2_PEEK_BYTES) or b''
+        if header.codec == CODEC_ZLIB:
+            try:
+                head = zlib.decompressobj().decompress(head, len(FILE_TYPE))
+            except zlib.error:
+                head = b''
+        header = header._replace(flags=_type_flags(head))
+    return header
+
+def _peek_body(strips, header, size):
+    # Up to size stored bytes from the start of the body header describes,
+    # or None if the cover can't hold that body
+    if PIXEL_MODES[header.mode].colors != strips.colors or header.channels > strips.bands:
+        return None
+    channels, body_offset = strips.channels, strips.body_offset
+    strips.use_channels(header.channels)
+    strips.body_offset = header.body_start
+    try:
+        if header.payload_size * 8 > (strips.value_count - _body_start(strips)) * header.bits_per_channel:
+            return None
+        return _read_range(strips, 0, min(size, header.payload_size), header.bits_per_channel)
+    finally:
+        strips.use_channels(channels)
+        strips.body_offset = body_offset
+
+def _header_strips(image, strips, header, stats=None):
+    # Cover strips that read the body as header describes it: the same
+    # pixels in another mode with the same colour bands if need be
+    if header.mode != strips.mode:
+        if PIXEL_MODES[header.mode].colors != strips.colors:
+            raise ValueError("Corrupt header: channel layout does not match the image.")
+        strips = _PixelStrips(image, header.mode, stats=stats)
+    strips.use_channels(header.channels)
+    strips.body_offset = header.body_start
+    return strips
+
+def _body_start(strips):
+    # Flat index of the first payload value, right after the header pixels
+    # unless an older header layout says otherwise
+    if strips.body_offset is not None:
+        return strips.body_offset
+    return header_pixels(strips.colors, strips.colors) * strips.channels
+
+def _payload_rows(strips, payload_size, bits_per_channel):
+    # Number of rows from the top that the header and a payload occupy
+    end = _body_start(strips) + -(-payload_size * 8 // bits_per_channel)
+    return min(strips.height, -(-end // strips.row_values))
+
+class _BodyWriter:
+    """Streams payload bytes into the body of a cover, one row strip at a time"""
+
+    def __init__(self, strips, bits_per_channel):
+        self.strips = strips
+        self.bits_per_channel = bits_per_channel
+        self.start = _body_start(strips)
+        self.capacity = max(0, strips.value_count - self.start)
+        self.max_bytes = self.capacity * bits_per_channel // 8
+        # Whole groups of bits_per_channel bytes always fill whole values
+        piece = strips.strip_rows * strips.row_values * bits_per_channel // 8
+        self.piece = max(bits_per_channel, piece - piece % bits_per_channel)
+        self.position = 0
+        self.size = 0
+        self.pending = b''
+
+    def write(self, data):
+        if self.pending:
+            data = self.pending + data
+        data = memoryview(data)
+        usable = len(data) - len(data) % self.bits_per_channel
+        for start in range(0, usable, self.piece):
+            self._embed(data[start:min(start + self.piece, usable)])
+        self.pending = bytes(data[usable:])
+
+    def close(self):
+        if self.pending:
+            self._embed(self.pending)
+            self.pending = b''
+
+    def _embed(self, data):
+        bits = bytes_to_bits(data)
+        count = -(-bits.size // self.bits_per_channel)
+        if self.position + count > self.capacity:
+            raise self._too_large()
+        self.strips.embed(self.start + self.position, bits, self.bits_per_channel)
+        self.position += count
+        self.size += len(data)
+
+    def _too_large(self):
+        return ValueError(f"Data too large for this image (max {self.max_bytes} bytes). Try using a larger image.")
+
+class _TiledBodyWriter(_BodyWriter):
+    """Collects the whole body, then embeds it tile by tile on worker processes.
+
+    Bodies under PARALLEL_MIN_BYTES are embedded in this process. Either way
+    the cover ends up exactly as _BodyWriter leaves it.
+    """
+
+    def __init__(self, strips, bits_per_channel, workers, cancel=None):
+        super().__init__(strips, bits_per_channel)
+        self.workers = workers
+        self.cancel = cancel
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if len(self.buffer) + len(data) > self.max_bytes:
+            raise self._too_large()
+        self.buffer += data
+
+    def close(self):
+        data, self.buffer = self.buffer, bytearray()
+        if len(data) < PARALLEL_MIN_BYTES:
+            super().write(data)
+            super().close()
+            return
+        _embed_tiles(self.strips, data, self.bits_per_channel, self.workers, self.cancel)
+        self.position = -(-len(data) * 8 // self.bits_per_channel)
+        self.size = len(data)
+
+@contextmanager
+def _shared_memory(size):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+    try:
+        yield shm
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _warm_worker():
+    # Bind the deferred modules before the first task arrives
+    np.ndarray, Image.Image
+
+def worker_pool(workers=None):
+    """A ProcessPoolExecutor of workers that start warm, for every parallel job of the package.
+
+    Where the platform has it, workers are forked from a server process
+    that imported WORKER_PRELOAD once, so a new worker costs a fork rather
+    than an interpreter start and imports, and never inherits the threads,
+    sockets or memory of its parent. Elsewhere they start as the platform
+    default does. Either way each worker imports NumPy and Pillow before
+    its first task and serves every task of the pool after that. Workers
+    import the main module too, so scripts that run parallel jobs need an
+    if __name__ == "__main__" guard, as they do on macOS and Windows.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(list(WORKER_PRELOAD))
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_warm_worker)
+
+def _tile_workers(workers):
+    # More workers than CPUs only adds overhead; None when one process will do
+    workers = min(workers or 1, os.cpu_count() or 1)
+    return workers if workers > 1 else None
+
+def _tiles(byte_count, bits_per_channel, workers):
+    # (first byte, byte count) of each tile. Tiles are whole multiples of
+    # bits_per_channel bytes, so each starts on a value boundary at a bit
+    # offset the worker can work out on its own.
+    step = -(-byte_count // (workers * TILES_PER_WORKER))
+    step += -step % bits_per_channel
+    return [(start, min(step, byte_count - start)) for start in range(0, byte_count, step)]
+
+def _band(strips, byte_count, bits_per_channel):
+    # The rows a body of byte_count bytes touches: all of them when scattered
+    if strips.scatter is not None:
+        return 0, strips.height
+    count = -(-byte_count * 8 // bits_per_channel)
+    top, bottom, _ = strips._span(_body_start(strips), count)
+    return top, bottom
+
+def _tile_positions(job, count):
+    # Flat indices in the band of the count values of a tile, as a slice or an array
+    _, _, band_start, _, body_start, start, _, bits_per_channel, scatter = job
+    slot = start * 8 // bits_per_channel
+    if scatter is None:
+        first = body_start + slot - band_start
+        return slice(first, first + count)
+    return body_start - band_start + scatter(np.arange(slot, slot + count, dtype=np.uint64))
+
+def _embed_tile(job):
+    pixels_name, (count, dtype), _, data_name, _, start, length, bits_per_channel, _ = job
+    pixels_shm = shared_memory.SharedMemory(name=pixels_name)
+    data_shm = shared_memory.SharedMemory(name=data_name)
+    try:
+        bits = bytes_to_bits(bytes(data_shm.buf[start:start + length]))
+        values = np.ndarray(count, dtype=dtype, buffer=pixels_shm.buf)
+        positions = _tile_positions(job, -(-bits.size // bits_per_channel))
+        chosen = values[positions]
+        embed_bits(chosen, bits, bits_per_channel)
+        values[positions] = chosen
+        del values, chosen
+    finally:
+        pixels_shm.close()
+        data_shm.close()
+
+def _extract_tile(job):
+    pixels_name, (count, dtype), _, out_name, _, start, length, bits_per_channel, _ = job
+    pixels_shm = shared_memory.SharedMemory(name=pixels_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        values = np.ndarray(count, dtype=dtype, buffer=pixels_shm.buf)
+        positions = _tile_positions(job, -(-length * 8 // bits_per_channel))
+        out_shm.buf[start:start + length] = bits_to_bytes(extract_bits(values[positions], length * 8, bits_per_channel))
+        del values
+    finally:
+        pixels_shm.close()
+        out_shm.close()
+
+def _run_tiles(worker, jobs, workers, cancel, progress=None, total=None):
+    pool = worker_pool(workers)
+    try:
+        done = 0
+        for job, _ in zip(jobs, pool.map(worker, jobs)):
+            _check_cancel(cancel)
+            done += job[6]
+            if progress is not None:
+                progress(done, total)
+    finally:
+        # Queued tiles are dropped if one fails or the job is cancelled
+        pool.shutdown(cancel_futures=True)
+
+def _embed_tiles(strips, data, bits_per_channel, workers, cancel=None):
+    # The values of the band of rows the body covers and the body itself go
+    # into shared memory; each worker embeds its tiles in place, and the
+    # band is copied back
+    top, bottom = _band(strips, len(data), bits_per_channel)
+    values = strips.read_values(top, bottom)
+    scatter = strips.scatter[1] if strips.scatter is not None else None
+    with _shared_memory(values.nbytes) as pixels_shm, _shared_memory(len(data)) as data_shm:
+        band = np.ndarray(values.shape, dtype=values.dtype, buffer=pixels_shm.buf)
+        band[...] = values
+        del values
+        data_shm.buf[:len(data)] = data
+        jobs = [(pixels_shm.name, (band.size, band.dtype.str), top * strips.row_values, data_shm.name,
+                 _body_start(strips), start, length, bits_per_channel, scatter)
+                for start, length in _tiles(len(data), bits_per_channel, workers)]
+        with _stage(strips.stats, 'embed'):
+            _run_tiles(_embed_tile, jobs, workers, cancel)
+        strips.write_values(top, band.copy() if strips.array is None else band)
+        del band
+    strips._touched(-(-len(data) * 8 // bits_per_channel))
+
+def _extract_tiles(strips, header, workers, progress=None, cancel=None):
+    # The reverse of _embed_tiles: workers write their tiles' bytes straight
+    # into a shared output buffer
+    size = header.payload_size
+    bits_per_channel = header.bits_per_channel
+    top, bottom = _band(strips, size, bits_per_channel)
+    values = strips.read_values(top, bottom)
+    scatter = strips.scatter[1] if strips.scatter is not None else None
+    with _shared_memory(values.nbytes) as pixels_shm, _shared_memory(size) as out_shm:
+        band = np.ndarray(values.shape, dtype=values.dtype, buffer=pixels_shm.buf)
+        band[...] = values
+        shape = (band.size, band.dtype.str)
+        del values, band
+        jobs = [(pixels_shm.name, shape, top * strips.row_values,
+                 out_shm.name, _body_start(strips), start, length, bits_per_channel, scatter)
+                for start, length in _tiles(size, bits_per_channel, workers)]
+        with _stage(strips.stats, 'extract'):
+            _run_tiles(_extract_tile, jobs, workers, cancel, progress, size)
+        data = bytes(out_shm.buf[:size])
+    strips._touched(-(-size * 8 // bits_per_channel))
+    return data
+
+def encode_image(cover, source, output=None, compress=True,
+                 bits_per_channel=BITS_PER_CHANNEL, use_alpha=False,
+                 compression=DEFAULT_COMPRESSION, profile=DEFAULT_PROFILE, progress=None, cancel=None,
+                 stats=None, key=None, workers=None):
+    """Embed a payload streamed from bytes, a binary file object or an iterable of chunks.
+
+    cover is a path, a RawImage, encoded image bytes, a binary file object,
+    a PIL image or a NumPy array, embedded in its own mode where it can be
+    (see cover_mode). The result is saved to output, a path or binary file
+    object, in the format of profile (see OUTPUT_PROFILES); without one it is
+    returned as an image or array like the cover, or as encoded bytes.
+    compression picks the codec (see choose_codec); compress=False stores.
+    progress, cancel and stats are as for iter_payload. A key scatters the
+    body over the image (see KeyedScatter), and workers > 1 embeds large
+    bodies tile by tile on that many processes. The README has the details.
+    """
+    _check_bits_per_channel(bits_per_channel)
+    profile = output_profile(profile)
+
+    total = _source_size(source)
+    sample, source = _sample_source(source)
+    flags = _type_flags(sample[:len(FILE_TYPE)])
+    if key is not None:
+        flags |= FLAG_KEYED
+    codec, level = CODEC_STORE, 0
+    if compress:
+        codec, level = choose_codec(sample, compression)
+    compressor = _compressor(codec, level)
+    if compressor:
+        compress_chunk = _timed(stats, 'compress', compressor.compress)
+        flush = _timed(stats, 'compress', compressor.flush)
+
+    strips, writer = _open_body(cover, bits_per_channel, use_alpha, cancel, stats, key, workers)
+    chunks = iter_chunks(source)
+    if progress is not None or cancel is not None:
+        chunks = _tracked(chunks, total, progress, cancel)
+    payload_size = 0
+    for chunk in chunks:
+        payload_size += len(chunk)
+        if compressor:
+            chunk = compress_chunk(chunk)
+        writer.write(chunk)
+    if compressor:
+        writer.write(flush())
+    writer.close()
+
+    _write_header(strips, pack_header(writer.size, flags, bits_per_channel, strips.channels, codec, strips.mode))
+    if stats is not None:
+        stats.count('payload_bytes', payload_size)
+        stats.count('stored_bytes', writer.size)
+    return _finish_cover(cover, strips, output, profile, cancel, stats)
+
+def _open_body(cover, bits_per_channel, use_alpha, cancel, stats, key, workers):
+    # The cover, opened for writing, and a writer for its body
+    with _stage(stats, 'open'):
+        strips = _PixelStrips(cover, writable=True, stats=stats, use_alpha=bool(use_alpha))
+    workers = _tile_workers(workers)
+    if workers:
+        writer = _TiledBodyWriter(strips, bits_per_channel, workers, cancel)
+    else:
+        writer = _BodyWriter(strips, bits_per_channel)
+    if key is not None:
+        strips.scatter_body(key)
+        writer.write(key_check(key))
+    return strips, writer
+
+def _finish_cover(cover, strips, output, profile, cancel, stats):
+    # Save the stego cover to output, or return it as encode_image describes
+    if output is not None:
+        _save_cover(strips, output, profile, cancel)
+        if stats is not None and isinstance(output, (str, os.PathLike)):
+            stats.count('image_bytes', os.path.getsize(output))
+    elif isinstance(cover, np.ndarray):
+        return strips.array[..., 0] if cover.ndim == 2 and strips.bands == 1 else strips.array
+    elif isinstance(cover, Image.Image):
+        return strips.image()
+    else:
+        buffer = io.BytesIO()
+        _save_cover(strips, buffer, profile, cancel)
+        if stats is not None:
+            stats.count('image_bytes', buffer.tell())
+        return buffer.getvalue()
+
+def encode_stream_to_image(image_path, source, output_path, compress=True,
+                           bits_per_channel=BITS_PER_CHANNEL, use_alpha=False,
+                           compression=DEFAULT_COMPRESSION, profile=DEFAULT_PROFILE, progress=None, cancel=None,
+                           stats=None, key=None, workers=None):
+    encode_image(image_path, source, output_path, compress, bits_per_channel, use_alpha, compression,
+                 profile, progress, cancel, stats, key, workers)
+
+def encode_data_to_image(image_path, data_bytes, output_path, compress=True,
+                         bits_per_channel=BITS_PER_CHANNEL, use_alpha=False,
+                         compression=DEFAULT_COMPRESSION, profile=DEFAULT_PROFILE, progress=None, cancel=None,
+                         stats=None, key=None, workers=None):
+    encode_image(image_path, data_bytes, output_path, compress, bits_per_channel, use_alpha, compression,
+                 profile, progress, cancel, stats, key, workers)
+
+def _archive_source(source):
+    # Entry payloads may also be paths, opened here and closed by the caller
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    return nullcontext(source)
+
+def _pack_entry(out, sample, chunks, compress, compression, stats):
+    # Compress one entry onto the end of out: (codec, size, stored size, CRC)
+    codec, level = choose_codec(sample, compression) if compress else (CODEC_STORE, 0)
+    compressor = _compressor(codec, level)
+    if compressor:
+        compress_chunk = _timed(stats, 'compress', compressor.compress)
+    start = out.tell()
+    size = crc = 0
+    for chunk in chunks:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        out.write(compress_chunk(chunk) if compressor else chunk)
+    if compressor:
+        out.write(_timed(stats, 'compress', compressor.flush)())
+    return codec, size, out.tell() - start, crc
+
+def pack_archive_index(entries):
+    """Build the index that starts an archive body from ArchiveEntry tuples"""
+    parts = []
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        parts.append(_ARCHIVE_ENTRY.pack(entry.offset, entry.stored_size, entry.size, CODEC_IDS[entry.codec],
+                                         entry.crc, len(name)) + name)
+    body = b''.join(parts)
+    return _ARCHIVE_INDEX.pack(len(body), len(parts)) + body
+
+def encode_archive(cover, entries, output=None, compress=True,
+                   bits_per_channel=BITS_PER_CHANNEL, use_alpha=False,
+                   compression=DEFAULT_COMPRESSION, profile=DEFAULT_PROFILE, progress=None, cancel=None,
+                   stats=None, key=None, workers=None):
+    """Hide several named payloads in one cover, as an archive any entry of which can be read alone.
+
+    entries maps names to payloads, or is an iterable of (name, payload)
+    pairs; a payload is a path or anything encode_image takes as a source.
+    Each entry is compressed on its own (codec picked as by encode_image)
+    into a spool, then the index and the entries are embedded as one body.
+    progress(done, total) counts original bytes over all entries. The other
+    arguments and the result are as for encode_image. Read archives back
+    with list_entries and iter_entry.
+    """
+    _check_bits_per_channel(bits_per_channel)
+    profile = output_profile(profile)
+    entries = list(entries.items() if hasattr(entries, 'items') else entries)
+    names = [name for name, _ in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("Archive entry names must be unique.")
+    if any(len(name.encode('utf-8')) > 0xFFFF for name in names):
+        raise ValueError("Archive entry names must be under 64 KiB.")
+
+    sizes = []
+    for _, source in entries:
+        size = os.path.getsize(source) if isinstance(source, (str, os.PathLike)) else _source_size(source)
+        sizes.append(size)
+    total = None if None in sizes else sum(sizes)
+    index = []
+    with tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_BYTES) as spool:
+        done = 0
+        for name, source in entries:
+            with _archive_source(source) as source:
+                sample, source = _sample_source(source)
+                chunks = iter_chunks(source)
+                if progress is not None or cancel is not None:
+                    report = None if progress is None else lambda count, _: progress(done + count, total)
+                    chunks = _tracked(chunks, None, report, cancel)
+                offset = spool.tell()
+                codec, size, stored_size, crc = _pack_entry(spool, sample, chunks, compress, compression, stats)
+            index.append(ArchiveEntry(name, size, stored_size, CODEC_NAMES[codec], crc, offset))
+            done += size
+
+        strips, writer = _open_body(cover, bits_per_channel, use_alpha, cancel, stats, key, workers)
+        writer.write(pack_archive_index(index))
+        spool.seek(0)
+        for chunk in iter_chunks(spool, STRIP_BYTES):
+            _check_cancel(cancel)
+            writer.write(chunk)
+        writer.close()
+
+    flags = FLAG_ARCHIVE | (FLAG_KEYED if key is not None else 0)
+    _write_header(strips, pack_header(writer.size, flags, bits_per_channel, strips.channels, CODEC_STORE,
+                                      strips.mode))
+    if stats is not None:
+        stats.count('payload_bytes', done)
+        stats.count('stored_bytes', writer.size)
+    return _finish_cover(cover, strips, output, profile, cancel, stats)
+
+def capacity(image, bits_per_channel=BITS_PER_CHANNEL, use_alpha=False):
+    """Largest payload, in bytes, an image can carry; reads only the header of an image file"""
+    strips = _PixelStrips(image)
+    return max_payload_size(strips.width, strips.height, bits_per_channel, use_alpha, strips.mode)
+
+def body_size(source, compress=True, compression=DEFAULT_COMPRESSION, key=None):
+    """Bytes a payload takes up in a cover, to compare with max_payload_size.
+
+    The payload is compressed exactly as encode_image would, without
+    keeping the output; a key adds its check bytes. A file object or
+    iterator source is consumed.
+    """
+    sample, source = _sample_source(source)
+    codec, level = choose_codec(sample, compression) if compress else (CODEC_STORE, 0)
+    compressor = _compressor(codec, level)
+    size = KEY_CHECK_SIZE if key is not None else 0
+    for chunk in iter_chunks(source):
+        size += len(compressor.compress(chunk)) if compressor else len(memoryview(chunk).cast('B'))
+    if compressor:
+        size += len(compressor.flush())
+    return size
+
+def probe(image, stats=None):
+    """Describe the payload an image carries, decoding only its first rows.
+
+    Returns a PayloadInfo (format version, codec name, bits per channel,
+    channels, stored payload size, kind: 'text', 'file', 'raw' or
+    'archive', whether it is keyed, and the cover mode), or
+    None when there is no header. Legacy EOF-marker images have no header
+    and so are not detected.
+    """
+    with _stage(stats, 'open'):
+        strips = _PixelStrips(image, stats=stats)
+    header = _read_header(strips)
+    if header is None:
+        return None
+    _check_header(_header_strips(image, strips, header, stats), header)
+    return PayloadInfo(header.version, CODEC_NAMES[header.codec], header.bits_per_channel,
+                       header.channels, header.payload_size, _payload_kind(header.flags),
+                       bool(header.flags & FLAG_KEYED), header.mode)
+
+def _decode_legacy(channels):
+    # Images written before format v2 end the payload with EOF_MARKER_BYTES
+    # and carry no header. One pass over all LSBs replaces the old quadratic
+    # rescan; the result is the same.
+    all_bytes = bits_to_bytes(channels & 1)
 
-def decode_data_from_image(image_path):
-    img = Image.open(image_path).convert("RGB")
-    width, height = img.size
-    pixels = img.load()
-    
-    mask = (1 << BITS_PER_CHANNEL) - 1
-    
-    binary_string = ""
-    
-    for y in range(height):
-        for x in range(width):
-            r, g, b = pixels[x, y]
-            
-            binary_string += str(r & 1)
-            binary_string += str(g & 1)
-            binary_string += str(b & 1)
-                
-            # Check for EOF marker periodically
-            if len(binary_string) % 1024 == 0:
-                # Convert current chunk to bytes
-                if len(binary_string) % 8 != 0:
-                    padded_binary = binary_string + '0' * (8 - (len(binary_string) % 8))
-                else:
-                    padded_binary = binary_string
-                
-                temp_bytes = from_binary(padded_binary)
-                # Check if EOF marker is in the current data
-                if EOF_MARKER_BYTES in temp_bytes:
-                    # Found the marker, no need to process more pixels
-                    all_bytes = from_binary(binary_string[:len(binary_string) - (len(binary_string) % 8)])
-                    marker_pos = all_bytes.find(EOF_MARKER_BYTES)
-                    data = all_bytes[:marker_pos]
-                    
-                    try:
-                        return zlib.decompress(data)
-                    except zlib.error:
-                        # If decompression fails, return the raw data
-                        return data
-    
-    if len(binary_string) % 8 != 0:
-        binary_string = binary_string + '0' * (8 - (len(binary_string) % 8))
-    
-    all_bytes = from_binary(binary_string)
-    
-    # Find the EOF marker
     marker_pos = all_bytes.find(EOF_MARKER_BYTES)
     if marker_pos != -1:
         # Get the data without the EOF marker
@@ -132,3 +1701,325 @@ def decode_data_from_image(image_path):
     else:
         # If no marker found, return all the data
         return all_bytes
+
+def _iter_body(strips, header, progress=None, cancel=None):
+    return _iter_range(strips, 0, header.payload_size, header.bits_per_channel, progress, cancel)
+
+def _iter_range(strips, start, size, bits_per_channel, progress=None, cancel=None):
+    # size bytes of the body from byte start on, reading only the values
+    # that hold them. Whole multiples of 8 values always hold whole bytes,
+    # whatever the depth; a start inside a value skips its first bits and
+    # carries the odd bits of each strip over to the next.
+    piece = max(8, strips.strip_rows * strips.row_values // 8 * 8)
+    position, skip = divmod(start * 8, bits_per_channel)
+    position += _body_start(strips)
+    remaining = skip + size * 8
+    carry = None
+    while remaining:
+        _check_cancel(cancel)
+        bit_count = min(remaining, piece * bits_per_channel)
+        bits = strips.extract(position, bit_count, bits_per_channel)[skip:]
+        skip = 0
+        if carry is not None:
+            bits = np.concatenate([carry, bits])
+        whole = bits.size - bits.size % 8
+        carry = bits[whole:] if whole < bits.size else None
+        yield bits_to_bytes(bits[:whole])
+        position += piece
+        remaining -= bit_count
+        if progress is not None:
+            progress(size - remaining // 8, size)
+
+def _inflate(chunks, codec, stats=None):
+    decompressor = _decompressor(codec)
+    decompress = _timed(stats, 'decompress', decompressor.decompress)
+    try:
+        for chunk in chunks:
+            # Bound each output chunk so highly compressible payloads stay small in memory
+            if codec == CODEC_ZLIB:
+                while chunk:
+                    yield decompress(chunk, STRIP_BYTES)
+                    chunk = decompressor.unconsumed_tail
+            else:
+                yield decompress(chunk, STRIP_BYTES)
+                while not decompressor.needs_input and not decompressor.eof:
+                    yield decompress(b'', STRIP_BYTES)
+        if codec == CODEC_ZLIB:
+            yield _timed(stats, 'decompress', decompressor.flush)()
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ValueError(f"Corrupt payload: {e}")
+    if not decompressor.eof:
+        raise ValueError("Corrupt payload: compressed data is truncated.")
+
+def _check_key(chunks, key):
+    # A keyed body starts with key_check(key); anything else means a wrong key
+    head = b''
+    for chunk in chunks:
+        if len(head) < KEY_CHECK_SIZE:
+            head += chunk
+            if len(head) < KEY_CHECK_SIZE:
+                continue
+            if head[:KEY_CHECK_SIZE] != key_check(key):
+                raise ValueError("Wrong key for this image.")
+            chunk = head[KEY_CHECK_SIZE:]
+        yield chunk
+    if len(head) < KEY_CHECK_SIZE:
+        raise ValueError("Corrupt payload: keyed body is truncated.")
+
+def _check_header(strips, header):
+    payload_bits = header.payload_size * 8
+    if payload_bits > (strips.value_count - _body_start(strips)) * header.bits_per_channel:
+        raise ValueError(f"Corrupt header: payload of {header.payload_size} bytes does not fit in this image.")
+
+def _read_range(strips, start, size, bits_per_channel):
+    return b''.join(_iter_range(strips, start, size, bits_per_channel))
+
+def _open_archive(image, stats, key):
+    # The cover of an archive, its header, its entries and where their data starts
+    with _stage(stats, 'open'):
+        strips = _PixelStrips(image, stats=stats)
+    header = _read_header(strips)
+    if header is None or not header.flags & FLAG_ARCHIVE:
+        raise ValueError("This image does not hold an archive.")
+    strips = _header_strips(image, strips, header, stats)
+    _check_header(strips, header)
+    bits_per_channel = header.bits_per_channel
+    start = 0
+    if header.flags & FLAG_KEYED:
+        if key is None:
+            raise ValueError("This image's payload is keyed: give the key to decode it.")
+        strips.scatter_body(key)
+        if _read_range(strips, 0, KEY_CHECK_SIZE, bits_per_channel) != key_check(key):
+            raise ValueError("Wrong key for this image.")
+        start = KEY_CHECK_SIZE
+
+    if header.payload_size < start + _ARCHIVE_INDEX.size:
+        raise ValueError("Corrupt archive: index is truncated.")
+    index_size, count = _ARCHIVE_INDEX.unpack(_read_range(strips, start, _ARCHIVE_INDEX.size, bits_per_channel))
+    start += _ARCHIVE_INDEX.size
+    if start + index_size > header.payload_size:
+        raise ValueError("Corrupt archive: index is truncated.")
+    index = _read_range(strips, start, index_size, bits_per_channel)
+    data_start = start + index_size
+    entries = []
+    position = 0
+    for _ in range(count):
+        if position + _ARCHIVE_ENTRY.size > index_size:
+            raise ValueError("Corrupt archive: index is truncated.")
+        offset, stored_size, size, codec, crc, name_size = _ARCHIVE_ENTRY.unpack_from(index, position)
+        position += _ARCHIVE_ENTRY.size
+        name = index[position:position + name_size].decode('utf-8', errors='replace')
+        position += name_size
+        if codec not in CODEC_NAMES or data_start + offset + stored_size > header.payload_size:
+            raise ValueError(f"Corrupt archive: bad index entry for {name!r}.")
+        entries.append(ArchiveEntry(name, size, stored_size, CODEC_NAMES[codec], crc, offset))
+    return strips, header, entries, data_start
+
+def list_entries(image, key=None, stats=None):
+    """The ArchiveEntry tuples of an archive encoded by encode_archive, reading only its index.
+
+    offset is where an entry's data starts past the index, size and crc
+    (CRC-32) describe its original bytes and stored_size its compressed ones.
+    """
+    return _open_archive(image, stats, key)[2]
+
+def iter_entry(image, name, progress=None, cancel=None, stats=None, key=None):
+    """Yield one archive entry in chunks, reading only the values that hold its bytes.
+
+    Raises KeyError for a name the archive does not have and ValueError if
+    the entry does not match its size and CRC. progress, cancel, stats and
+    key are as for iter_payload.
+    """
+    strips, header, entries, data_start = _open_archive(image, stats, key)
+    entry = next((entry for entry in entries if entry.name == name), None)
+    if entry is None:
+        raise KeyError(name)
+    chunks = _iter_range(strips, data_start + entry.offset, entry.stored_size, header.bits_per_channel,
+                         progress, cancel)
+    codec = CODEC_IDS[entry.codec]
+    if codec != CODEC_STORE:
+        chunks = _inflate(chunks, codec, stats)
+    size = crc = 0
+    for chunk in chunks:
+        if chunk:
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+    if size != entry.size or crc != entry.crc:
+        raise ValueError(f"Corrupt archive entry {name!r}: size or CRC does not match.")
+    if stats is not None:
+        stats.count('stored_bytes', entry.stored_size)
+        stats.count('payload_bytes', size)
+
+def decode_entry(image, name, progress=None, cancel=None, stats=None, key=None):
+    """Return one entry of an archive as bytes (see iter_entry)"""
+    return b''.join(iter_entry(image, name, progress, cancel, stats, key))
+
+def iter_payload(image, progress=None, cancel=None, stats=None, key=None, workers=None):
+    """Yield the hidden payload of an image in chunks, reading it strip by strip.
+
+    image is anything encode_image takes as a cover; images and arrays are
+    read in place, without a copy. progress(done, total) is called after
+    each strip with the stored (possibly compressed) bytes read so far, and
+    cancel is checked before each one, raising Cancelled once set. A Stats
+    passed as stats records the time and volume of each stage. Payloads
+    embedded with a key need the same key. With workers > 1, bodies of
+    PARALLEL_MIN_BYTES or more are extracted tile by tile on that many
+    worker processes and held in memory.
+    """
+    with _stage(stats, 'open'):
+        strips = _PixelStrips(image, stats=stats)
+
+    header = _read_header(strips)
+    if header is None:
+        _check_cancel(cancel)
+        strips.reserve(strips.height)
+        with _stage(stats, 'extract'):
+            pixels = strips.read_rows(0, strips.height)
+            data = _decode_legacy(pixels[..., :COLOR_CHANNELS].reshape(-1))
+        if stats is not None:
+            stats.count('pixels', strips.width * strips.height)
+            stats.count('payload_bytes', len(data))
+        if progress is not None:
+            progress(len(data), len(data))
+        yield data
+        return
+
+    strips = _header_strips(image, strips, header, stats)
+    _check_header(strips, header)
+    if header.flags & FLAG_ARCHIVE:
+        raise ValueError("This image holds an archive: list its entries or extract one by name.")
+
+    keyed = header.flags & FLAG_KEYED
+    if keyed:
+        if key is None:
+            raise ValueError("This image's payload is keyed: give the key to decode it.")
+        strips.scatter_body(key)
+    else:
+        # Decode and read exactly the rows the payload occupies, then stop
+        strips.reserve(_payload_rows(strips, header.payload_size, header.bits_per_channel))
+    workers = _tile_workers(workers)
+    if workers and header.payload_size >= PARALLEL_MIN_BYTES:
+        chunks = iter([_extract_tiles(strips, header, workers, progress, cancel)])
+    else:
+        chunks = _iter_body(strips, header, progress, cancel)
+    if keyed:
+        chunks = _check_key(chunks, key)
+    if header.codec != CODEC_STORE:
+        chunks = _inflate(chunks, header.codec, stats)
+    payload_size = 0
+    for chunk in chunks:
+        if chunk:
+            payload_size += len(chunk)
+            yield chunk
+    if stats is not None:
+        stats.count('stored_bytes', header.payload_size)
+        stats.count('payload_bytes', payload_size)
+
+def decode_image(image, progress=None, cancel=None, stats=None, key=None, workers=None):
+    """Return the hidden payload of a path, image bytes, file object, PIL image or array"""
+    return b''.join(iter_payload(image, progress, cancel, stats, key, workers))
+
+def decode_data_from_image(image_path, progress=None, cancel=None, stats=None, key=None, workers=None):
+    return decode_image(image_path, progress, cancel, stats, key, workers)
+
+def file_type_prefix(file_ext):
+    """Build the FILE: prefix that precedes a hidden file's content"""
+    ext_bytes = file_ext.encode('utf-8')
+    # The extension length is packed as a 2-byte integer
+    return FILE_TYPE + struct.pack('!H', len(ext_bytes)) + ext_bytes
+
+def safe_extension(file_ext):
+    """A hidden file's extension reduced to letters, digits, '.', '_' and '-', fit for a file name or header.
+
+    The extension comes from the image, so anyone can put path separators or
+    control characters in it; an extension with nothing left is ''.
+    """
+    ext = re.sub(r'[^A-Za-z0-9._-]', '', file_ext or '').lstrip('.')
+    return '.' + ext if ext.strip('.') else ''
+
+class _TypedPayloadWriter:
+    """Strips the TXT/FILE type prefix off a decoded stream and writes the content to a file object"""
+
+    def __init__(self, out):
+        self.out = out
+        self.head = b''
+        self.kind = None
+        self.extension = None
+        self.size = 0
+
+    def write(self, chunk):
+        if self.kind is None:
+            self.head += chunk
+            if not self._parse_prefix():
+                return
+            chunk, self.head = self.head, b''
+        if chunk:
+            self.out.write(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        if self.kind is None:
+            # The payload ended before a complete type prefix: keep it as is
+            self.kind = 'raw'
+            chunk, self.head = self.head, b''
+            self.write(chunk)
+
+    def _parse_prefix(self):
+        head = self.head
+        if head.startswith(TEXT_TYPE):
+            self.kind = 'text'
+            self.head = head[len(TEXT_TYPE):]
+            return True
+        if head.startswith(FILE_TYPE):
+            start = len(FILE_TYPE) + 2
+            if len(head) < start:
+                return False
+            ext_len = struct.unpack('!H', head[len(FILE_TYPE):start])[0]
+            if len(head) < start + ext_len:
+                return False
+            self.kind = 'file'
+            self.extension = head[start:start + ext_len].decode('utf-8', errors='replace')
+            self.head = head[start + ext_len:]
+            return True
+        if not (TEXT_TYPE.startswith(head) or FILE_TYPE.startswith(head)):
+            # Legacy or untyped payload
+            self.kind = 'raw'
+            return True
+        return False
+
+def decode_stream_from_image(image, sink, progress=None, cancel=None, stats=None, key=None, workers=None):
+    """Decode an image's payload straight into sink, a path or a binary file object.
+
+    The TXT/FILE prefix is parsed as the payload streams through and only the
+    content is written, so memory stays constant however large the payload.
+    Returns a DecodedPayload with the kind ('text', 'file' or 'raw'), the
+    file extension and the number of bytes written. progress, cancel,
+    stats, key and workers are as for iter_payload. A path sink is only
+    replaced once the whole payload is decoded, and may not be the image.
+    """
+    if isinstance(sink, (str, os.PathLike)):
+        source = image.path if isinstance(image, RawImage) else image
+        if (isinstance(source, (str, os.PathLike)) and os.path.exists(sink) and os.path.exists(source)
+                and os.path.samefile(sink, source)):
+            raise ValueError("The output would overwrite the image being decoded.")
+        decoded = []
+
+        def write(path):
+            with open(path, 'wb') as out:
+                decoded.append(decode_stream_from_image(image, out, progress, cancel, stats, key, workers))
+
+        _write_replacing(sink, write)
+        return decoded[0]
+
+    writer = _TypedPayloadWriter(sink)
+    for chunk in iter_payload(image, progress, cancel, stats, key, workers):
+        writer.write(chunk)
+    writer.close()
+    return DecodedPayload(writer.kind, writer.extension, writer.size)
+
+if __name__ == "__main__":
+    # python -m stego_core runs the headless command line interface
+    import sys
+    from stego_cli import main
+    sys.exit(main())
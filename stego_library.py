@@ -0,0 +1,201 @@
+"""Cover library: an SQLite index of cover images, to pick the smallest one a payload fits in"""
+import os
+import sqlite3
+from collections import Counter, namedtuple
+from stego_core import cover_mode, max_payload_size, worker_pool, BITS_PER_CHANNEL, MAX_BITS_PER_CHANNEL, PIXEL_MODES
+from stego_scan import iter_images, SCAN_EXTENSIONS, SCAN_BATCH
+
+# Row pairs the texture score samples, spread evenly down the image
+TEXTURE_ROWS = 256
+# Covers analysed between commits, so an interrupted update keeps its work
+LIBRARY_COMMIT_EVERY = 256
+
+CoverRecord = namedtuple('CoverRecord', 'path mtime_ns size width height mode texture')
+
+# Capacities are keyed by setting first, so the smallest cover a payload fits
+# in is one descent of the primary key
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS covers (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    texture REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS capacities (
+    bits_per_channel INTEGER NOT NULL,
+    use_alpha INTEGER NOT NULL,
+    capacity INTEGER NOT NULL,
+    cover INTEGER NOT NULL,
+    PRIMARY KEY (bits_per_channel, use_alpha, capacity, cover)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS capacities_cover ON capacities (cover);
+"""
+_COVER_COLUMNS = "path, mtime_ns, size, width, height, mode, texture"
+
+def texture_score(pixels, colors):
+    """Mean difference between neighbouring colour values of a (height, width, bands) array, from 0 to 255.
+
+    Flat images score near 0 and noisy ones high; changed low bits are
+    harder to tell apart from the noise of a busy cover. Only TEXTURE_ROWS
+    pairs of rows are looked at.
+    """
+    import numpy as np
+    height = pixels.shape[0]
+    scale = 255 / np.iinfo(pixels.dtype).max
+    rows = np.unique(np.linspace(0, max(0, height - 2), min(TEXTURE_ROWS, height)).astype(np.intp))
+    top = pixels[rows, :, :colors].astype(np.float32)
+    diffs = [np.abs(np.diff(top, axis=1)).ravel()]
+    if height > 1:
+        diffs.append(np.abs(pixels[rows + 1, :, :colors].astype(np.float32) - top).ravel())
+    diffs = np.concatenate(diffs)
+    return float(diffs.mean() * scale) if len(diffs) else 0.0
+
+def describe_cover(path, mtime_ns=None, size=None):
+    """Open a cover and measure it as a CoverRecord; the image is decoded once, in the mode it embeds in"""
+    # NumPy and Pillow are only loaded where covers are analysed, so
+    # looking covers up in the index stays quick to start
+    import numpy as np
+    from PIL import Image
+    if mtime_ns is None or size is None:
+        stat = os.stat(path)
+        mtime_ns, size = stat.st_mtime_ns, stat.st_size
+    with Image.open(path) as img:
+        mode = cover_mode(img.mode)[0]
+        pixels = np.asarray(img if img.mode == mode else img.convert(mode))
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    height, width = pixels.shape[:2]
+    return CoverRecord(os.path.abspath(path), mtime_ns, size, width, height, mode,
+                       texture_score(pixels, PIXEL_MODES[mode].colors))
+
+def cover_capacities(record):
+    """(bits per channel, use_alpha, capacity in bytes) for every setting a cover can be used with"""
+    for bits_per_channel in range(1, MAX_BITS_PER_CHANNEL + 1):
+        for use_alpha in (False, True):
+            try:
+                capacity = max_payload_size(record.width, record.height, bits_per_channel, use_alpha, record.mode)
+            except ValueError:
+                # No alpha channel to embed in
+                continue
+            yield bits_per_channel, use_alpha, capacity
+
+def _describe(entry):
+    try:
+        return entry[0], describe_cover(*entry)
+    except Exception as e:
+        return entry[0], e
+
+def _describe_all(files, workers):
+    if workers == 1 or len(files) < 2:
+        return map(_describe, files)
+    with worker_pool(workers) as pool:
+        # Results are few and small: collect them before the pool shuts down
+        return list(pool.map(_describe, files, chunksize=SCAN_BATCH))
+
+class CoverLibrary:
+    """An SQLite index of cover images: their size, mode, texture and capacity at every setting.
+
+    update() brings the index in line with directories of covers, opening
+    only files that are new or changed since; pick() finds the smallest
+    cover a payload fits in with a lookup ordered by capacity, so the
+    cost grows with the log of the library size.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM covers").fetchone()[0]
+
+    def update(self, roots, workers=None, extensions=SCAN_EXTENSIONS):
+        """Index the covers under roots, returning a Counter of added, updated, unchanged, removed and failed.
+
+        Files whose mtime and size are unchanged are not opened; new and
+        changed ones are analysed on a pool of worker processes. Indexed
+        covers under roots that are gone are dropped, and so are files
+        that no longer open as images.
+        """
+        workers = workers or os.cpu_count() or 1
+        known = {path: (cover_id, mtime_ns, size) for cover_id, path, mtime_ns, size
+                 in self.db.execute("SELECT id, path, mtime_ns, size FROM covers")}
+        totals = Counter()
+        seen = set()
+        changed = []
+        for root in roots:
+            root = os.path.abspath(root)
+            if os.path.exists(root):
+                for path, mtime_ns, size in iter_images([root], extensions):
+                    seen.add(path)
+                    stored = known.get(path)
+                    if stored is not None and stored[1:] == (mtime_ns, size):
+                        totals['unchanged'] += 1
+                    else:
+                        changed.append((path, mtime_ns, size))
+            gone = [path for path in known if path not in seen and
+                    (path == root or path.startswith(os.path.join(root, '')))]
+            for path in gone:
+                self._remove(known.pop(path)[0])
+                totals['removed'] += 1
+        self.db.commit()
+
+        for done, (path, record) in enumerate(_describe_all(changed, workers), 1):
+            stored = known.get(path)
+            if stored is not None:
+                self._remove(stored[0])
+            if isinstance(record, Exception):
+                totals['failed'] += 1
+            else:
+                self._add(record)
+                totals['updated' if stored is not None else 'added'] += 1
+            if done % LIBRARY_COMMIT_EVERY == 0:
+                self.db.commit()
+        self.db.commit()
+        return totals
+
+    def _add(self, record):
+        cover_id = self.db.execute(f"INSERT INTO covers ({_COVER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   record).lastrowid
+        self.db.executemany("INSERT INTO capacities VALUES (?, ?, ?, ?)",
+                            [setting + (cover_id,) for setting in cover_capacities(record)])
+
+    def _remove(self, cover_id):
+        self.db.execute("DELETE FROM capacities WHERE cover = ?", (cover_id,))
+        self.db.execute("DELETE FROM covers WHERE id = ?", (cover_id,))
+
+    def pick(self, payload_size, bits_per_channel=BITS_PER_CHANNEL, use_alpha=False, min_texture=0.0):
+        """The CoverRecord of the smallest cover payload_size bytes fit in, or None.
+
+        payload_size is what the payload takes up in the cover (see
+        body_size). Covers with a texture score below min_texture are
+        passed over, and so are files changed since they were indexed.
+        """
+        if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL:
+            raise ValueError(f"Bits per channel must be between 1 and {MAX_BITS_PER_CHANNEL}, got {bits_per_channel}")
+        rows = self.db.execute(
+            f"SELECT {_COVER_COLUMNS} FROM capacities JOIN covers ON id = cover "
+            "WHERE bits_per_channel = ? AND use_alpha = ? AND capacity >= ? AND texture >= ? "
+            "ORDER BY capacity, cover",
+            (bits_per_channel, bool(use_alpha), payload_size, min_texture))
+        for record in map(CoverRecord._make, rows):
+            try:
+                stat = os.stat(record.path)
+            except OSError:
+                continue
+            if (stat.st_mtime_ns, stat.st_size) == (record.mtime_ns, record.size):
+                return record
+        return None
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,160 @@
+"""Corpus triage: find the images under a directory that carry a payload: python -m stego_core scan"""
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+from stego_core import probe, worker_pool
+
+SCAN_EXTENSIONS = ('.png', '.webp', '.tif', '.tiff', '.bmp', '.ppm')
+# Files per task: enough to amortise the trip to a worker, few enough that
+# results keep streaming
+SCAN_BATCH = 32
+
+def iter_images(roots, extensions=SCAN_EXTENSIONS):
+    """Yield (path, mtime_ns, size) for every image file under roots, in sorted order.
+
+    Files named directly in roots are included whatever their extension;
+    symlinked directories are not followed and unreadable ones are skipped.
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    for root in roots:
+        root = os.path.abspath(root)
+        if not os.path.isdir(root):
+            stat = os.stat(root)
+            yield root, stat.st_mtime_ns, stat.st_size
+            continue
+        stack = [root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(extensions) and entry.is_file():
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime_ns, stat.st_size
+            stack.extend(reversed(subdirs))
+
+def scan_file(path, mtime_ns=None, size=None):
+    """Probe one image, describing it as a JSON-ready dict.
+
+    status is 'payload' (with the PayloadInfo fields under payload), 'clean'
+    or 'error'. Only the header rows are decoded, so clean images cost
+    about as much as opening them. Legacy EOF-marker payloads have no
+    header and show up as clean.
+    """
+    if mtime_ns is None or size is None:
+        stat = os.stat(path)
+        mtime_ns, size = stat.st_mtime_ns, stat.st_size
+    record = {"path": path, "mtime_ns": mtime_ns, "size": size}
+    try:
+        info = probe(path)
+        record["status"] = "clean" if info is None else "payload"
+        record["payload"] = info._asdict() if info else None
+    except Exception as e:
+        record.update(status="error", error=str(e))
+    return record
+
+def _scan_batch(files):
+    return [scan_file(*entry) for entry in files]
+
+class ScanIndex:
+    """Results of earlier scans, as JSON lines keyed by path, mtime and size.
+
+    Results are appended as they come in, so an interrupted scan keeps the
+    files it got through; on close, lines superseded by newer results are
+    compacted away.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lines = 0
+        ends_cleanly = True
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    ends_cleanly = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Cut short by an interrupted scan
+                        continue
+                    self.entries[record["path"]] = record
+                    self.lines += 1
+        self.file = open(path, "a")
+        if not ends_cleanly:
+            self.file.write("\n")
+
+    def lookup(self, path, mtime_ns, size):
+        """The stored result for a file, or None if it is new or has changed"""
+        record = self.entries.get(path)
+        if record and record["mtime_ns"] == mtime_ns and record["size"] == size:
+            return record
+        return None
+
+    def add(self, record):
+        self.entries[record["path"]] = record
+        self.file.write(json.dumps(record) + "\n")
+        self.lines += 1
+
+    def close(self):
+        self.file.close()
+        if self.lines > len(self.entries):
+            temp_path = self.path + ".part"
+            with open(temp_path, "w") as f:
+                for record in self.entries.values():
+                    f.write(json.dumps(record) + "\n")
+            os.replace(temp_path, self.path)
+            self.lines = len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def scan(roots, index=None, workers=None, extensions=SCAN_EXTENSIONS, batch_size=SCAN_BATCH):
+    """Yield a result dict (see scan_file) for every image under roots, as soon as it is known.
+
+    Files are probed in batches on a pool of worker processes, with only a
+    few batches per worker in flight, so trees of any size stream in
+    constant memory. Results come back in completion order. With a
+    ScanIndex, files whose mtime and size are unchanged are not opened at
+    all; their stored result is yielded with "cached": true, and new
+    results are added to the index.
+    """
+    workers = workers or os.cpu_count() or 1
+    files = iter_images(roots, extensions)
+    with worker_pool(workers) as pool:
+        pending = set()
+        batch = []
+        walking = True
+        while walking or batch or pending:
+            for path, mtime_ns, size in files:
+                record = index.lookup(path, mtime_ns, size) if index is not None else None
+                if record:
+                    yield dict(record, cached=True)
+                    continue
+                batch.append((path, mtime_ns, size))
+                if len(batch) >= batch_size:
+                    break
+            else:
+                walking = False
+            if batch:
+                pending.add(pool.submit(_scan_batch, batch))
+                batch = []
+            # Wait only when the window is full or there is nothing left to walk
+            if len(pending) >= workers * 4 or not walking:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = {future for future in pending if future.done()}
+                pending -= done
+            for future in done:
+                for record in future.result():
+                    if index is not None:
+                        index.add(record)
+                    yield record
@@ -0,0 +1,403 @@
+"""Asyncio HTTP service around stego_core: python -m stego_core serve"""
+import asyncio
+import io
+import json
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import contextmanager
+from email.message import Message
+from urllib.parse import parse_qsl, quote, urlsplit
+from stego_core import (encode_image, decode_stream_from_image, probe, capacity, file_type_prefix, output_profile,
+                        safe_extension, worker_pool, Stats, TEXT_TYPE, BITS_PER_CHANNEL, DEFAULT_COMPRESSION,
+                        DEFAULT_PROFILE)
+
+# Limits: request bodies, the request line and headers, and the time a
+# client gets to send its request
+MAX_BODY = 64 << 20
+MAX_HEADERS = 100
+REQUEST_TIMEOUT = 30
+# Jobs that may wait for a worker on top of the running ones before new
+# requests are turned away with 429
+QUEUE_PER_WORKER = 2
+
+CONTENT_TYPES = {'PNG': 'image/png', 'WEBP': 'image/webp', 'TIFF': 'image/tiff', 'BMP': 'image/bmp',
+                 'PPM': 'image/x-portable-pixmap', 'RAW': 'application/octet-stream'}
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           408: 'Request Timeout', 411: 'Length Required', 413: 'Payload Too Large',
+           429: 'Too Many Requests', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+# Jobs run in the worker processes, so they take and return plain bytes,
+# along with the stats of the run
+
+@contextmanager
+def _readable_image():
+    # Only the workers load Pillow, so its error for an unreadable image
+    # becomes a ValueError before it reaches the front process
+    from PIL import UnidentifiedImageError
+    try:
+        yield
+    except UnidentifiedImageError:
+        raise ValueError("Not an image Pillow can read.")
+
+def _encode_job(cover, payload, options):
+    stats = Stats()
+    with _readable_image():
+        return encode_image(cover, payload, stats=stats, **options), stats.as_dict()
+
+def _decode_job(image, key=None):
+    stats = Stats()
+    out = io.BytesIO()
+    with _readable_image():
+        payload = decode_stream_from_image(image, out, stats=stats, key=key)
+    return (payload.kind, payload.extension, out.getvalue()), stats.as_dict()
+
+def _probe_job(image):
+    stats = Stats()
+    with _readable_image():
+        info = probe(image, stats)
+        return {"capacity": capacity(image), "payload": info._asdict() if info else None}, stats.as_dict()
+
+def server_timing(stats):
+    """Server-Timing header value for a job's stats, in milliseconds per stage"""
+    return ', '.join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in stats["seconds"].items())
+
+def parse_multipart(content_type, body):
+    """Split a multipart/form-data body into {name: (filename, data)}"""
+    header = Message()
+    header['content-type'] = content_type
+    boundary = header.get_param('boundary')
+    if not boundary:
+        raise HTTPError(400, "Multipart body without a boundary.")
+    fields = {}
+    for part in body.split(b'--' + boundary.encode('latin-1'))[1:-1]:
+        head, _, data = part[2:-2].partition(b'\r\n\r\n')
+        headers = Message()
+        for line in head.decode('latin-1').split('\r\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip()] = value.strip()
+        name = headers.get_param('name', header='content-disposition')
+        if name:
+            fields[name] = (headers.get_param('filename', header='content-disposition'), data)
+    return fields
+
+class StegoService:
+    """HTTP front end that hands encode, decode and probe work to a process pool.
+
+    At most workers + queue_size jobs are admitted at a time; past that,
+    requests get 429 as soon as their headers are in, and their bodies are
+    never kept in memory.
+    """
+
+    def __init__(self, workers=None, queue_size=None, max_body=MAX_BODY, timeout=REQUEST_TIMEOUT):
+        self.workers = workers or os.cpu_count() or 1
+        self.limit = self.workers + (self.workers * QUEUE_PER_WORKER if queue_size is None else queue_size)
+        self.max_body = max_body
+        self.timeout = timeout
+        self.pool = None
+        self.active = 0
+        self.started = time.time()
+        self.requests = Counter()
+        self.seconds = Counter()
+        self.rejected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Totals of the stats the workers send back
+        self.stage_seconds = Counter()
+        self.stage_counts = Counter()
+        self.routes = {
+            ('POST', '/encode'): self.encode,
+            ('POST', '/decode'): self.decode,
+            ('POST', '/probe'): self.probe,
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.metrics,
+        }
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.pool = worker_pool(self.workers)
+        # Start every worker before listening, so the first requests do not wait for them
+        await asyncio.gather(*(self._run(int) for _ in range(self.workers)))
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        started = time.perf_counter()
+        route = None
+        admitted = False
+        try:
+            try:
+                method, target, headers = await asyncio.wait_for(self._read_head(reader), self.timeout)
+                path = urlsplit(target).path
+                route = self.routes.get((method, path))
+                if method == 'OPTIONS':
+                    response = (204, {}, b'')
+                elif route is None:
+                    known = any(path == route_path for _, route_path in self.routes)
+                    raise HTTPError(405 if known else 404, f"No route for {method} {path}")
+                else:
+                    body = b''
+                    if method == 'POST':
+                        admitted = self._admit()
+                        body = await asyncio.wait_for(self._read_body(reader, writer, headers, admitted),
+                                                      self.timeout)
+                    response = await route(target, headers, body)
+            except HTTPError as e:
+                response = self._error(e.status, str(e))
+            except asyncio.TimeoutError:
+                response = self._error(408, "Request took too long to arrive.")
+            except (ValueError, OSError) as e:
+                # Bad covers, payloads that do not fit, unknown options
+                response = self._error(400, str(e))
+            except Exception as e:
+                response = self._error(500, f"{type(e).__name__}: {e}")
+            finally:
+                if admitted:
+                    self.active -= 1
+            status, extra, body = response
+            try:
+                self._send(writer, status, extra, body)
+            except ValueError as e:
+                # A header that cannot go on the wire; nothing was written yet
+                status, extra, body = self._error(500, f"Could not send the response: {e}")
+                self._send(writer, status, extra, body)
+            await writer.drain()
+            name = route.__name__ if route else 'other'
+            self.requests[name, status] += 1
+            self.seconds[name] += time.perf_counter() - started
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _admit(self):
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    async def _read_head(self, reader):
+        try:
+            line = await reader.readuntil(b'\r\n')
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                if line == b'\r\n':
+                    break
+                if len(headers) >= MAX_HEADERS:
+                    raise HTTPError(431, "Too many headers.")
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, "Request line or header too long.")
+        except ValueError:
+            raise HTTPError(400, "Malformed request.")
+        return method, target, headers
+
+    async def _read_body(self, reader, writer, headers, admitted):
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPError(411, "Chunked bodies are not supported; send Content-Length.")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, "Bad Content-Length.")
+        too_large = length > self.max_body
+        expecting = headers.get('expect', '').lower() == '100-continue'
+        if admitted and not too_large:
+            if expecting:
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            self.bytes_in += length
+            return await reader.readexactly(length)
+
+        # Turned away. Unless the client is waiting for 100 Continue, read the
+        # body off the socket without keeping it, so it sees the error
+        # instead of a reset
+        while length and not expecting:
+            chunk = await reader.read(min(length, 1 << 16))
+            if not chunk:
+                break
+            length -= len(chunk)
+        if too_large:
+            raise HTTPError(413, f"Request body over {self.max_body} bytes.")
+        self.rejected += 1
+        raise HTTPError(429, "Server is busy, try again shortly.")
+
+    def _send(self, writer, status, extra, body):
+        headers = {
+            'Content-Length': str(len(body)),
+            'Connection': 'close',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Stego-Key',
+            'Access-Control-Expose-Headers': 'X-Payload-Kind, X-Payload-Extension, Server-Timing',
+        }
+        headers.update(extra)
+        if any('\r' in value or '\n' in value for value in headers.values()):
+            raise ValueError("line break in a response header")
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        self.bytes_out += len(body)
+
+    def _error(self, status, message):
+        extra = {'Content-Type': 'application/json'}
+        if status == 429:
+            extra['Retry-After'] = '1'
+        return status, extra, json.dumps({"error": message}).encode()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    async def _run_job(self, func, *args):
+        # Run a job, add its stats to the totals and describe them in a header
+        result, stats = await self._run(func, *args)
+        self.stage_seconds.update(stats["seconds"])
+        self.stage_counts.update(stats["counts"])
+        return result, {'Server-Timing': server_timing(stats)}
+
+    def _image(self, headers, body):
+        # A bare image body, or the "image" field of a form
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            image = parse_multipart(content_type, body).get('image')
+            if image is None:
+                raise HTTPError(400, "Form has no image field.")
+            return image[1]
+        if not body:
+            raise HTTPError(400, "Send an image in the request body.")
+        return body
+
+    async def encode(self, target, headers, body):
+        """Form fields: cover, and text or file; optional bits, alpha, compress, compression, profile, key.
+
+        The options can also go in the query string, except key, which may
+        come in an X-Stego-Key header instead.
+        """
+        content_type = headers.get('content-type', '')
+        if not content_type.startswith('multipart/form-data'):
+            raise HTTPError(400, "Send the cover and payload as multipart/form-data.")
+        fields = parse_multipart(content_type, body)
+        options = dict(parse_qsl(urlsplit(target).query))
+        # Keys travel in the form or a header rather than the URL, which ends up in logs
+        if 'key' in options:
+            raise HTTPError(400, "Send the key as a form field or in the X-Stego-Key header, not in the URL.")
+        options.update((name, data.decode('utf-8')) for name, (filename, data) in fields.items()
+                       if filename is None and name not in ('cover', 'text', 'file'))
+        if 'cover' not in fields:
+            raise HTTPError(400, "Form has no cover field.")
+        if ('text' in fields) == ('file' in fields):
+            raise HTTPError(400, "Give exactly one of text or file.")
+        if 'text' in fields:
+            payload = TEXT_TYPE + fields['text'][1]
+        else:
+            filename, data = fields['file']
+            payload = file_type_prefix(os.path.splitext(filename or '')[1]) + data
+
+        try:
+            profile = output_profile(options.get('profile', DEFAULT_PROFILE))
+            settings = {
+                'compress': _flag(options.get('compress', 'true')),
+                'bits_per_channel': int(options.get('bits', BITS_PER_CHANNEL)),
+                'use_alpha': _flag(options.get('alpha', 'false')),
+                'compression': options.get('compression', DEFAULT_COMPRESSION),
+                'profile': profile,
+                'key': options.get('key') or headers.get('x-stego-key') or None,
+            }
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        image, extra = await self._run_job(_encode_job, fields['cover'][1], payload, settings)
+        extra.update({'Content-Type': CONTENT_TYPES[profile.format],
+                      'Content-Disposition': f'attachment; filename="stego{profile.extension}"'})
+        return 200, extra, image
+
+    async def decode(self, target, headers, body):
+        # Keys travel in a header rather than the URL, which ends up in logs
+        key = headers.get('x-stego-key') or None
+        (kind, extension, content), extra = await self._run_job(_decode_job, self._image(headers, body), key)
+        extra['X-Payload-Kind'] = kind
+        if kind == 'text':
+            extra['Content-Type'] = 'text/plain; charset=utf-8'
+        else:
+            extra['Content-Type'] = 'application/octet-stream'
+            if extension is not None:
+                # The extension comes from the image: only a plain one goes in a
+                # header as it is, and the full one only percent-encoded
+                printable = ''.join(char for char in extension if char.isprintable() and char not in '/\\')
+                extra['X-Payload-Extension'] = safe_extension(extension)
+                extra['Content-Disposition'] = (f'attachment; filename="payload{safe_extension(extension)}"; '
+                                                f"filename*=UTF-8''{quote('payload' + printable, safe='')}")
+        return 200, extra, content
+
+    async def probe(self, target, headers, body):
+        result, extra = await self._run_job(_probe_job, self._image(headers, body))
+        extra['Content-Type'] = 'application/json'
+        return 200, extra, json.dumps(result).encode()
+
+    async def health(self, target, headers, body):
+        status = {"status": "ok", "workers": self.workers, "active": self.active, "limit": self.limit,
+                  "uptime": round(time.time() - self.started, 1)}
+        return 200, {'Content-Type': 'application/json'}, json.dumps(status).encode()
+
+    async def metrics(self, target, headers, body):
+        """Prometheus text format"""
+        lines = [
+            "# TYPE stego_requests_total counter",
+            *(f'stego_requests_total{{endpoint="{name}",status="{status}"}} {count}'
+              for (name, status), count in sorted(self.requests.items())),
+            "# TYPE stego_request_seconds_total counter",
+            *(f'stego_request_seconds_total{{endpoint="{name}"}} {seconds:.6f}'
+              for name, seconds in sorted(self.seconds.items())),
+            "# TYPE stego_rejected_total counter",
+            f"stego_rejected_total {self.rejected}",
+            "# TYPE stego_jobs_active gauge",
+            f"stego_jobs_active {self.active}",
+            "# TYPE stego_jobs_limit gauge",
+            f"stego_jobs_limit {self.limit}",
+            "# TYPE stego_received_bytes_total counter",
+            f"stego_received_bytes_total {self.bytes_in}",
+            "# TYPE stego_sent_bytes_total counter",
+            f"stego_sent_bytes_total {self.bytes_out}",
+            "# TYPE stego_stage_seconds_total counter",
+            *(f'stego_stage_seconds_total{{stage="{name}"}} {seconds:.6f}'
+              for name, seconds in sorted(self.stage_seconds.items())),
+            "# TYPE stego_stage_total counter",
+            *(f'stego_stage_total{{counter="{name}"}} {count}'
+              for name, count in sorted(self.stage_counts.items())),
+        ]
+        return 200, {'Content-Type': 'text/plain; version=0.0.4'}, ("\n".join(lines) + "\n").encode()
+
+def serve(host='127.0.0.1', port=8080, workers=None, queue_size=None, max_body=MAX_BODY):
+    """Run the service until SIGINT or SIGTERM, then shut the workers down"""
+    async def run():
+        service = StegoService(workers, queue_size, max_body)
+        server = await service.start(host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except NotImplementedError:
+                # Windows: Ctrl+C still arrives as KeyboardInterrupt
+                pass
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            service.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,124 @@
+import os
+import struct
+from stego_core import (encode_data_to_image, decode_data_from_image, max_payload_size,
+                        choose_codec, compress_bytes, decompress_bytes,
+                        BITS_PER_CHANNEL, CODEC_STORE, CODEC_NAMES, DEFAULT_COMPRESSION, DEFAULT_PROFILE,
+                        SAMPLE_SIZE, worker_pool)
+
+# Every shard starts with this record, followed by its slice of the payload.
+# The payload ID ties the shards of one payload together; index and count
+# let the decoder put them back in order and notice missing ones. The codec
+# is the one the whole payload was compressed with before it was split.
+SHARD_TYPE = b'SHARD:'
+_SHARD = struct.Struct('!8sHHB')
+SHARD_HEADER_SIZE = len(SHARD_TYPE) + _SHARD.size
+MAX_SHARDS = 0xFFFF
+
+def pack_shard(payload_id, index, count, data, codec=CODEC_STORE):
+    """Prefix one slice of a payload with its shard record"""
+    return SHARD_TYPE + _SHARD.pack(payload_id, index, count, codec) + data
+
+def unpack_shard(shard_bytes):
+    """Split a decoded shard into (payload_id, index, count, codec, data)"""
+    if not shard_bytes.startswith(SHARD_TYPE) or len(shard_bytes) < SHARD_HEADER_SIZE:
+        raise ValueError("Image does not contain a payload shard.")
+    payload_id, index, count, codec = _SHARD.unpack(shard_bytes[len(SHARD_TYPE):SHARD_HEADER_SIZE])
+    if codec not in CODEC_NAMES:
+        raise ValueError(f"Unsupported compression codec {codec}")
+    return payload_id, index, count, codec, shard_bytes[SHARD_HEADER_SIZE:]
+
+def shard_capacity(cover_path, bits_per_channel=BITS_PER_CHANNEL, use_alpha=False):
+    """Payload bytes one cover can carry as a shard"""
+    from PIL import Image
+    with Image.open(cover_path) as img:
+        width, height = img.size
+        mode = img.mode
+    return max(0, max_payload_size(width, height, bits_per_channel, use_alpha, mode) - SHARD_HEADER_SIZE)
+
+def split_sizes(total, capacities):
+    """Split total bytes across covers in proportion to their capacity"""
+    space = sum(capacities)
+    if total > space:
+        raise ValueError(f"Data too large ({total} bytes) for these images (max {space} bytes). Try adding more images.")
+    sizes = [total * capacity // space if space else 0 for capacity in capacities]
+    # Hand out the rounding remainder to covers that still have room
+    leftover = total - sum(sizes)
+    for i, capacity in enumerate(capacities):
+        extra = min(leftover, capacity - sizes[i])
+        sizes[i] += extra
+        leftover -= extra
+    return sizes
+
+def _encode_shard(job):
+    cover_path, shard, output_path, bits_per_channel, use_alpha, profile = job
+    # The payload was compressed as a whole before it was split
+    encode_data_to_image(cover_path, shard, output_path, compress=False,
+                         bits_per_channel=bits_per_channel, use_alpha=use_alpha, profile=profile)
+    return output_path
+
+def encode_sharded(cover_paths, data_bytes, output_paths, compress=True,
+                   bits_per_channel=BITS_PER_CHANNEL, use_alpha=False, max_workers=None,
+                   compression=DEFAULT_COMPRESSION, profile=DEFAULT_PROFILE):
+    """Split a payload across several covers and encode them in parallel.
+
+    Returns the payload ID shared by the shards.
+    """
+    if len(cover_paths) != len(output_paths):
+        raise ValueError("Need one output path per cover image.")
+    if not 0 < len(cover_paths) <= MAX_SHARDS:
+        raise ValueError(f"Need between 1 and {MAX_SHARDS} cover images.")
+
+    codec = CODEC_STORE
+    if compress:
+        codec, level = choose_codec(data_bytes[:SAMPLE_SIZE], compression)
+        data_bytes = compress_bytes(data_bytes, codec, level)
+
+    capacities = [shard_capacity(path, bits_per_channel, use_alpha) for path in cover_paths]
+    sizes = split_sizes(len(data_bytes), capacities)
+
+    payload_id = os.urandom(8)
+    count = len(cover_paths)
+    view = memoryview(data_bytes)
+    jobs = []
+    offset = 0
+    for index, (cover_path, output_path, size) in enumerate(zip(cover_paths, output_paths, sizes)):
+        shard = pack_shard(payload_id, index, count, bytes(view[offset:offset + size]), codec)
+        jobs.append((cover_path, shard, output_path, bits_per_channel, use_alpha, profile))
+        offset += size
+
+    with worker_pool(max_workers) as pool:
+        list(pool.map(_encode_shard, jobs))
+    return payload_id
+
+def decode_sharded(image_paths, max_workers=None):
+    """Decode a set of shard images in parallel and reassemble the payload, in any order"""
+    if not image_paths:
+        raise ValueError("No shard images given.")
+    with worker_pool(max_workers) as pool:
+        decoded = list(pool.map(decode_data_from_image, image_paths))
+
+    shards = {}
+    payload_ids = set()
+    counts = set()
+    codec = CODEC_STORE
+    for shard_bytes in decoded:
+        payload_id, index, count, codec, data = unpack_shard(shard_bytes)
+        if index in shards:
+            raise ValueError(f"Shard {index} was given more than once.")
+        payload_ids.add(payload_id)
+        counts.add(count)
+        shards[index] = data
+
+    if len(payload_ids) > 1:
+        raise ValueError("Images belong to different payloads.")
+    if len(counts) > 1:
+        raise ValueError(f"Shards disagree on how many there are: {', '.join(map(str, sorted(counts)))}.")
+    count = counts.pop()
+    outside = sorted(index for index in shards if index >= count)
+    if outside:
+        raise ValueError(f"Shard {outside[0]} is out of range for a payload of {count} shards.")
+    missing = sorted(set(range(count)) - set(shards))
+    if missing:
+        raise ValueError(f"Missing {len(missing)} of {count} shards (first missing: {missing[0]}).")
+
+    return decompress_bytes(b''.join(shards[index] for index in range(count)), codec)